@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# coding: UTF-8
+
+#    Offline load test for signalmail: drives msgRcvV2 through a stand-in for
+#    the signal-cli DBus object, delivers into a local SMTP sink and reports
+#    throughput, end-to-end latency percentiles and peak RSS.
+#
+#    With --transport dbus messages are injected on a GLib main loop with
+#    GLib.idle_add(), the same way pydbus dispatches MessageReceivedV2, so
+#    pydbus, PyGObject and python-magic have to be installed like for
+#    signalmail itself. With --transport jsonrpc they are pushed as "receive"
+#    notifications by a fake signal-cli JSON-RPC daemon on a Unix socket and
+#    only python-magic is needed. No signal-cli, DBus daemon or mail server
+#    is needed.
+#
+#    Example: python bench/benchmark.py --messages 2000 --rate 200 --attachment-sizes 0,0,0,100k,1M
+
+
+import sys
+import os
+import argparse
+import tempfile
+import threading
+import time
+import random
+import re
+import resource
+import base64
+from functools import partial
+
+from smtpsink import SMTPSink
+from fakesignalcli import FakeSignalCli
+
+parser = argparse.ArgumentParser(description="signalmail load test with a fake signal-cli and a local SMTP sink")
+parser.add_argument("--messages", type=int, default=1000, help="number of Signal messages to inject (default: 1000)")
+parser.add_argument("--rate", type=float, default=0, help="messages per second, 0 injects as fast as possible (default: 0)")
+parser.add_argument("--groups", type=int, default=10, help="number of distinct groups (default: 10)")
+parser.add_argument("--senders", type=int, default=50, help="number of distinct senders (default: 50)")
+parser.add_argument("--direct-ratio", dest="direct_ratio", type=float, default=0.2, help="share of direct (non-group) messages (default: 0.2)")
+parser.add_argument("--mentions", type=int, default=1, help="mentions per message (default: 1)")
+parser.add_argument("--attachment-sizes", dest="attachment_sizes", default="0",
+                    help="comma separated attachment sizes picked at random per message, k/M suffixes allowed, 0 for none (default: 0)")
+parser.add_argument("--workers", type=int, default=2, help="signalmail delivery_workers (default: 2)")
+parser.add_argument("--digest-window", dest="digest_window", type=int, default=0, help="signalmail digest window in seconds (default: 0)")
+parser.add_argument("--transport", choices=["dbus", "jsonrpc"], default="dbus", help="how signalmail talks to the fake signal-cli (default: dbus)")
+parser.add_argument("--lookup-latency", dest="lookup_latency", type=float, default=1.0, help="milliseconds per fake signal-cli name lookup (default: 1)")
+parser.add_argument("--smtp-latency", dest="smtp_latency", type=float, default=0.0, help="milliseconds the sink takes per mail (default: 0)")
+parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for all mails (default: 300)")
+parser.add_argument("--seed", type=int, default=1, help="random seed (default: 1)")
+parser.add_argument("--debug", action="store_true", help="run signalmail in debug mode")
+args = parser.parse_args()
+
+def parseSize(size):
+    size = size.strip()
+    factor = {"k": 1024, "K": 1024, "m": 1024 * 1024, "M": 1024 * 1024}.get(size[-1:], 1)
+    return int(float(size[:-1] if factor != 1 else size) * factor)
+
+attachmentSizes = [parseSize(size) for size in args.attachment_sizes.split(",")]
+random.seed(args.seed)
+
+# signalmail reads its configuration and command line at import time
+workdir = tempfile.mkdtemp(prefix="signalmail-bench-")
+attachmentdir = os.path.join(workdir, "attachments", "")
+os.makedirs(attachmentdir)
+
+received = {} # message number -> monotonic time the sink got it
+receivedLock = threading.Lock()
+allReceived = threading.Event()
+benchPattern = re.compile(rb"bench message (\d+)\b")
+
+def onMail(mailfrom, rcpttos, data):
+    now = time.monotonic()
+    with receivedLock:
+        for number in benchPattern.findall(data):
+            received.setdefault(int(number), now)
+        if len(received) >= args.messages:
+            allReceived.set()
+
+sink = SMTPSink(onMail, latency=args.smtp_latency / 1000.0).start()
+
+if args.transport == "jsonrpc":
+    fakeSignalCli = FakeSignalCli(os.path.join(workdir, "socket"), latency=args.lookup_latency / 1000.0).start()
+
+with open(os.path.join(workdir, "config.ini"), "w") as fp:
+    fp.write("""[SWITCHES]
+debug = {debug}
+sendmail = True
+deleteattachments = True
+
+[SIGNAL]
+signalnumber = +10000000000
+signalname = Benchmark Gateway
+signalsettingspath = {workdir}
+transport = {transport}
+jsonrpc_address = {workdir}/socket
+
+[MAIL]
+mailfrom = "{{senderName}}" <bench@localhost>
+mailsubject = Forwarded Signal Message from "{{senderName}}"
+bodyheading = New Signal message from {{senderName}} ({{senderId}}) in {{groupName}}, sent {{timestamp}}:
+mailsignature = Signal Forwarding Bot for {{senderName}} ({{senderId}})
+addr_list = list@localhost
+smtpserver = 127.0.0.1
+smtpport = {port}
+smtpuser =
+smtppassword =
+smtpstarttls = False
+max_attachmentsize = 1024
+delivery_workers = {workers}
+
+[DIGEST]
+window = {digest}
+
+[HEADERS]
+X-Signal-Sender-Id = {{senderId}}
+X-Signal-Group-Id = {{groupId}}
+
+[CONTACTS]
+
+[EXCLUDE]
+""".format(debug=args.debug, port=sink.port, workers=args.workers, digest=args.digest_window, workdir=workdir, transport=args.transport))
+
+sys.argv = ["signalmail.py", "--data-dir", workdir]
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import signalmail
+
+
+# stand-in for the org.asamk.Signal object of signal-cli, every call takes lookup_latency
+class FakeSignal:
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def call(self):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def getContactName(self, number):
+        self.call()
+        return "Contact " + number[-4:]
+
+    def getGroupName(self, groupId):
+        self.call()
+        return "Group " + bytes(groupId[:2]).hex()
+
+    def setContactName(self, number, name):
+        self.call()
+
+    def sendMessage(self, message, attachments, recipient):
+        self.call()
+        return int(time.time() * 1000)
+
+    def getSelfNumber(self):
+        return "+10000000000"
+
+
+account = signalmail.settings.accounts[0]
+if args.transport == "jsonrpc":
+    signalmail.connectToJsonRpc(signalmail.settings.accounts, partial(signalmail.callbackLoop.post, signalmail.receiveEnvelope))
+    fake = fakeSignalCli
+else:
+    fake = FakeSignal(args.lookup_latency / 1000.0)
+    account.signal_client = fake
+
+senders = ["+1555%07d" % number for number in range(args.senders)]
+groups = [[random.randrange(256) for byte in range(32)] for group in range(args.groups)]
+
+# build all messages and attachment files before the clock starts
+messages = []
+for number in range(args.messages):
+    sender = random.choice(senders)
+    groupId = [] if random.random() < args.direct_ratio else random.choice(groups)
+    text = "bench message " + str(number) + " "
+    mentions = []
+    for mention in range(args.mentions):
+        mentions.append({"recipient": random.choice(senders), "start": len(text), "length": 1})
+        text += "￼ "
+    text += "lorem ipsum dolor sit amet " * random.randint(1, 20)
+    attachments = []
+    size = random.choice(attachmentSizes)
+    if size:
+        path = os.path.join(attachmentdir, "attachment-" + str(number))
+        with open(path, "wb") as fp:
+            fp.write(os.urandom(size))
+        attachments.append({"file": path, "contentType": "application/octet-stream", "fileName": "bench-" + str(number) + ".bin", "size": size})
+    # Signal timestamps are unique per sender, signalmail drops repeated ones
+    timestamp = int(time.time() * 1000) + number
+    if args.transport == "jsonrpc":
+        # what signal-cli sends, attachments are found by id in signalsettingspath
+        dataMessage = {"timestamp": timestamp, "message": text,
+                       "mentions": [{"number": mention["recipient"], "start": mention["start"], "length": mention["length"]} for mention in mentions],
+                       "attachments": [{"id": os.path.basename(attachment["file"]), "contentType": attachment["contentType"],
+                                        "filename": attachment["fileName"], "size": attachment["size"]} for attachment in attachments]}
+        if groupId:
+            dataMessage["groupInfo"] = {"groupId": base64.b64encode(bytes(groupId)).decode("ascii"), "type": "DELIVER"}
+        messages.append({"source": sender, "sourceNumber": sender, "timestamp": timestamp, "dataMessage": dataMessage})
+    else:
+        extras = {"mentions": mentions, "attachments": attachments}
+        messages.append((timestamp, sender, groupId, text, extras))
+
+baselineRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+if args.transport == "jsonrpc":
+    loop = signalmail.callbackLoop
+else:
+    loop = signalmail.GLib.MainLoop()
+threading.Thread(target=loop.run, name="mainloop", daemon=True).start()
+signalmail.outbox.load()
+signalmail.outbox.start()
+signalmail.spill.start()
+signalmail.startDeliveryWorkers()
+
+# inject on the main loop like pydbus does or through the socket, paced to --rate
+injected = {}
+start = time.monotonic()
+for number, message in enumerate(messages):
+    if args.rate:
+        delay = start + number / args.rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+    injected[number] = time.monotonic()
+    if args.transport == "jsonrpc":
+        fake.push(message)
+    else:
+        signalmail.GLib.idle_add(signalmail.msgRcvV2, account, *message)
+injectionTime = time.monotonic() - start
+
+finished = allReceived.wait(args.timeout)
+elapsed = time.monotonic() - start
+loop.quit()
+
+latencies = sorted(received[number] - injected[number] for number in received)
+def percentile(fraction):
+    if not latencies:
+        return float("nan")
+    return latencies[min(int(fraction * len(latencies)), len(latencies) - 1)] * 1000.0
+
+peakRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+print("messages injected   %d in %.2f s" % (len(messages), injectionTime))
+print("messages delivered  %d%s" % (len(received), "" if finished else " (timed out)"))
+print("mails / connections %d / %d" % (sink.mails, sink.connections))
+print("fake signal-cli calls %d (%s)" % (fake.calls, args.transport))
+print("elapsed             %.2f s" % elapsed)
+print("throughput          %.1f msg/s" % (len(received) / elapsed if elapsed else 0))
+print("latency p50         %.1f ms" % percentile(0.50))
+print("latency p90         %.1f ms" % percentile(0.90))
+print("latency p99         %.1f ms" % percentile(0.99))
+print("latency max         %.1f ms" % (latencies[-1] * 1000.0 if latencies else float("nan")))
+print("peak RSS            %.1f MB (%.1f MB before injecting)" % (peakRSS / 1024.0, baselineRSS / 1024.0))
+print("work directory      " + workdir)
+sys.exit(0 if finished else 1)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# coding: UTF-8
+
+#    Stand-in for "signal-cli daemon --socket" / "--tcp" for the signalmail
+#    benchmark: answers listContacts, listGroups, updateContact and send
+#    after a fixed latency, concurrently like signal-cli does, and pushes
+#    "receive" notifications with push(). Needs nothing but the standard
+#    library.
+
+
+import asyncio
+import base64
+import json
+import threading
+import time
+
+
+class FakeSignalCli:
+    # listens on the Unix socket path, or on 127.0.0.1:port if path is None
+    def __init__(self, path=None, port=0, latency=0.0, account="+10000000000"):
+        self.path = path
+        self.port = port
+        self.latency = latency
+        self.account = account
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.writers = []
+        self.connected = threading.Event()
+        self.loop = asyncio.new_event_loop()
+
+    @property
+    def address(self):
+        return self.path if self.path else "127.0.0.1:" + str(self.port)
+
+    def start(self):
+        self.loop.run_until_complete(self.listen())
+        threading.Thread(target=self.loop.run_forever, name="fakesignalcli", daemon=True).start()
+        return self
+
+    async def listen(self):
+        if self.path:
+            self.server = await asyncio.start_unix_server(self.handle, self.path)
+        else:
+            self.server = await asyncio.start_server(self.handle, "127.0.0.1", self.port)
+            self.port = self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        self.writers.append(writer)
+        self.connected.set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                self.loop.create_task(self.answer(writer, json.loads(line)))
+        finally:
+            self.writers.remove(writer)
+
+    async def answer(self, writer, request):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request.get("params") or {}
+        method = request.get("method")
+        if method == "listContacts":
+            result = [{"number": number, "uuid": None, "name": "Contact " + number[-4:]} for number in params.get("recipient", [])]
+        elif method == "listGroups":
+            result = [{"id": groupId, "name": "Group " + base64.b64decode(groupId)[:2].hex()} for groupId in params.get("groupId", [])]
+        elif method == "updateContact":
+            result = {}
+        elif method == "send":
+            result = {"timestamp": int(time.time() * 1000), "results": []}
+        else:
+            self.write(writer, {"jsonrpc": "2.0", "id": request.get("id"), "error": {"code": -32601, "message": "Method not implemented"}})
+            return
+        self.write(writer, {"jsonrpc": "2.0", "id": request.get("id"), "result": result})
+
+    def write(self, writer, message):
+        writer.write(json.dumps(message).encode("utf-8") + b"\n")
+
+    # thread safe, sends the envelope to every connected client like signal-cli does
+    def push(self, envelope):
+        notification = {"jsonrpc": "2.0", "method": "receive", "params": {"envelope": envelope, "account": self.account}}
+        self.loop.call_soon_threadsafe(self.broadcast, notification)
+
+    def broadcast(self, notification):
+        for writer in self.writers:
+            self.write(writer, notification)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="fake signal-cli JSON-RPC daemon for signalmail tests, pushes the envelopes of a JSON lines file")
+    parser.add_argument("--socket", help="Unix socket to listen on")
+    parser.add_argument("--port", type=int, default=7583, help="TCP port to listen on without --socket (default: 7583)")
+    parser.add_argument("--latency", type=float, default=0.0, help="milliseconds per call (default: 0)")
+    parser.add_argument("--replay", help="JSON lines file of envelopes to push once signalmail has connected")
+    args = parser.parse_args()
+    fake = FakeSignalCli(args.socket, args.port, args.latency / 1000.0).start()
+    print("listening on " + fake.address, flush=True)
+    if args.replay:
+        fake.connected.wait()
+        with open(args.replay, encoding="utf-8") as fp:
+            for line in fp:
+                if line.strip():
+                    record = json.loads(line)
+                    fake.push(record.get("envelope", record))
+    threading.Event().wait()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# coding: UTF-8
+
+#    Local SMTP sink for the signalmail benchmark: accepts every mail on
+#    127.0.0.1 and hands it to a callback instead of delivering it.
+#    Speaks just enough SMTP for smtplib (EHLO, AUTH, MAIL, RCPT, DATA, RSET,
+#    NOOP, QUIT), no STARTTLS, so signalmail has to run with smtpstarttls = False.
+
+
+import socketserver
+import threading
+import time
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        sink = self.server
+        with sink.lock:
+            sink.connections += 1
+        self.reply("220 signalmail benchmark sink")
+        mailfrom = None
+        rcpttos = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("ascii", "replace").strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb in ("EHLO", "HELO"):
+                self.reply("250-signalmail-sink")
+                self.reply("250-8BITMIME")
+                self.reply("250 AUTH PLAIN LOGIN")
+            elif verb == "AUTH":
+                self.reply("235 2.7.0 accepted")
+            elif verb == "MAIL":
+                mailfrom = command[len("MAIL FROM:"):].strip()
+                rcpttos = []
+                self.reply("250 2.1.0 ok")
+            elif verb == "RCPT":
+                rcpttos.append(command[len("RCPT TO:"):].strip())
+                self.reply("250 2.1.5 ok")
+            elif verb == "DATA":
+                self.reply("354 end data with <CR><LF>.<CR><LF>")
+                data = self.readData()
+                if data is None:
+                    return
+                if sink.latency:
+                    time.sleep(sink.latency)
+                sink.received(mailfrom, rcpttos, data)
+                self.reply("250 2.0.0 queued")
+            elif verb == "RSET":
+                mailfrom = None
+                rcpttos = []
+                self.reply("250 2.0.0 ok")
+            elif verb == "NOOP":
+                self.reply("250 2.0.0 ok")
+            elif verb == "QUIT":
+                self.reply("221 2.0.0 bye")
+                return
+            else:
+                self.reply("502 5.5.2 command not implemented")
+
+    # reads the DATA stream up to the final dot, undoing the dot-stuffing
+    def readData(self):
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return None
+            if line == b".\r\n":
+                return b"".join(lines)
+            if line.startswith(b".."):
+                line = line[1:]
+            lines.append(line)
+
+
+# threaded SMTP server, callback(mailfrom, rcpttos, data) is called for every mail
+class SMTPSink(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, callback, port=0, latency=0.0):
+        super().__init__(("127.0.0.1", port), SMTPSinkHandler)
+        self.callback = callback
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.mails = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def received(self, mailfrom, rcpttos, data):
+        with self.lock:
+            self.mails += 1
+        self.callback(mailfrom, rcpttos, data)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name="smtpsink", daemon=True)
+        thread.start()
+        return self
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="SMTP sink for signalmail tests, prints a line per received mail")
+    parser.add_argument("--port", type=int, default=8025, help="port to listen on (default: 8025)")
+    args = parser.parse_args()
+    sink = SMTPSink(lambda mailfrom, rcpttos, data: print(mailfrom, "->", ", ".join(rcpttos), len(data), "bytes", flush=True), args.port)
+    print("listening on 127.0.0.1:" + str(sink.port))
+    sink.serve_forever()
@@ -13,23 +13,58 @@ version = "0.7.2"
 
 import sys
 import os
+import importlib # for importing heavy modules on first use
 import argparse # argument parser
 import json # for json handling
+import re # for parsing templates
 import configparser # for config file
 import datetime # for decoding timestamps
 import time # for timestamp formatting / modification
-import smtplib # for sending mails
+import threading # for closing idle SMTP sessions and delivery workers
+import queue # for handing messages from the DBus callback to the delivery workers
+import itertools # for unique outbox entry names
+import collections # for the LRU order of the name cache
 import mimetypes # for guessing extension of attachment filenames, because Signal does not use them
-from email.message import EmailMessage # for sending mails
+import uuid # for MIME boundaries of streamed mails
+import hashlib # for naming files in the attachment store
+import logging # for the leveled log of all subsystems
+import logging.handlers # for writing the log off the calling threads
+import atexit # for flushing the log at exit
+import signal # for reloading the configuration on SIGHUP
 
 import base64  # because DBus processor strips contentType
-import magic   # because DBus processor strips contentType
 
-from pydbus import SessionBus   # for DBus processing
-from pydbus import SystemBus   # for DBus processing
-from gi.repository import GLib  # for DBus processing
+# heavy modules are only loaded on first use, so signalmail listens for messages sooner
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+smtplib = LazyModule("smtplib") # for sending mails
+emailMessage = LazyModule("email.message") # for sending mails
+emailPolicy = LazyModule("email.policy") # for CRLF line endings in spooled mails
+futures = LazyModule("concurrent.futures") # for processing oversize attachments
+multiprocessing = LazyModule("multiprocessing") # for processing oversize attachments
+magic = LazyModule("magic")   # because DBus processor strips contentType
+asyncio = LazyModule("asyncio") # for the JSON-RPC transport
+
+# only needed for the DBus transport
+try:
+    from pydbus import SessionBus   # for DBus processing
+    from pydbus import SystemBus   # for DBus processing
+    from gi.repository import GLib  # for DBus processing
+except ImportError:
+    SessionBus = SystemBus = GLib = None
 
-from functools import reduce, singledispatch
+from functools import singledispatch, lru_cache, partial
 
 #default data_dir is ${HOME}/.local/share/signalmail/
 data_dir = os.path.join("$HOME",".local","share","signalmail","")
@@ -48,6 +83,8 @@ parser.add_argument("--debug", action="store_true", help="override config and sw
 parser.add_argument("--no-autoreply", dest="no_autoreply", action="store_true", help="override config and do not send autoreply")
 parser.add_argument("--system", dest="system", action="store_true", help="override config and use system DBus")
 parser.add_argument("--useAPIV2", dest="useAPIV2", action="store_true", help="override config and use API V2")
+parser.add_argument("--ingest", metavar="FILE", help="forward the messages in FILE, the output of 'signal-cli receive --json' (- for stdin), and exit")
+parser.add_argument("--offline", action="store_true", help="with --ingest: do not connect to signal-cli, take names from the messages")
 
 args=parser.parse_args()
 
@@ -80,27 +117,12 @@ config.optionxform = lambda option: option # otherwise it's lowercase only
 config_file = os.path.join(data_dir, 'config.ini')
 if args.config_file:
     if os.path.isabs(args.config_file):
-        config_File = argts.config_file
+        config_file = args.config_file
     else:
         config_file = os.path.join(data_dir, args.config_file)
 
-config.read(data_dir + 'config.ini')
-#mandatory config variables
-try:
-    signalnumber = config['SIGNAL']['signalnumber']
-    signalname = config['SIGNAL']['signalname']
-    mailfrom = config['MAIL']['mailfrom']
-    mailsubject = config['MAIL']['mailsubject']
-    mailsignature = config['MAIL']['mailsignature']
-    bodyHeading = config['MAIL']['bodyheading']
-    addr_list = config['MAIL']['addr_list']
-    smtpserver = config['MAIL']['smtpserver']
-    smtpuser = config['MAIL']['smtpuser']
-    smtppassword = config['MAIL']['smtppassword']
-except KeyError as key:
-    print(key)
-    print("Configuration error -- " + data_dir + "config.ini incomplete, missing key " + str(key) + ".", file=sys.stderr)
-    raise SystemExit(1)
+config.read(config_file)
+# the mandatory settings are read by Settings below
 
 #optional config variables, with defaults
 debug = False
@@ -144,9 +166,85 @@ try:
     signalsettingspath = config['SIGNAL']['signalsettingspath']
 except KeyError: True
 
-smtpport = 587
+# how to talk to signal-cli: "dbus" (signal-cli daemon, needs pydbus and PyGObject)
+# or "jsonrpc" (signal-cli daemon --socket or --tcp)
+signal_transport = "dbus"
+try:
+    signal_transport = config['SIGNAL'].get('transport', signal_transport).strip().lower()
+except KeyError: True
+if signal_transport not in ("dbus", "jsonrpc"):
+    print("Configuration error -- transport must be dbus or jsonrpc, not " + signal_transport, file=sys.stderr)
+    raise SystemExit(1)
+
+# path of the Unix socket or host:port of the JSON-RPC daemon
+jsonrpc_address = os.path.join('$XDG_RUNTIME_DIR', 'signal-cli', 'socket')
+try:
+    jsonrpc_address = config['SIGNAL'].get('jsonrpc_address', jsonrpc_address)
+except KeyError: True
+jsonrpc_address = os.path.expanduser(os.path.expandvars(jsonrpc_address))
+
+# messages waiting for a delivery worker; when queue_size are waiting, new messages
+# block the main loop ("block"), are merged into one mail per group or sender every
+# coalesce_window seconds ("coalesce") or are written to data_dir until there is room ("spill").
+# Mails waiting for quota tokens hold their worker with "block", otherwise they wait in the outbox.
+queue_size = 1000
+try:
+    queue_size = config['MAIL'].getint('queue_size', queue_size)
+except KeyError: True
+
+queue_policy = "spill"
 try:
-    smtpport = config['MAIL']['smtpport']
+    queue_policy = config['MAIL'].get('queue_policy', queue_policy).strip().lower()
+except KeyError: True
+if queue_policy not in ("block", "coalesce", "spill"):
+    print("Configuration error -- queue_policy must be block, coalesce or spill, not " + queue_policy, file=sys.stderr)
+    raise SystemExit(1)
+
+coalesce_window = 60
+try:
+    coalesce_window = config['MAIL'].getint('coalesce_window', coalesce_window)
+except KeyError: True
+
+# seconds an unused SMTP session is kept open before it is closed
+smtp_idletimeout = 60
+try:
+    smtp_idletimeout = config['MAIL'].getint('smtp_idletimeout', smtp_idletimeout)
+except KeyError: True
+
+# backoff in seconds before retrying a message the SMTP server did not accept,
+# doubled on every failed attempt up to retry_max
+retry_initial = 30
+try:
+    retry_initial = config['MAIL'].getint('retry_initial', retry_initial)
+except KeyError: True
+
+retry_max = 3600
+try:
+    retry_max = config['MAIL'].getint('retry_max', retry_max)
+except KeyError: True
+
+# buffer size in bytes used when streaming attachments into the outbox and mails to the SMTP server
+stream_buffersize = 65536
+try:
+    stream_buffersize = config['MAIL'].getint('stream_buffersize', stream_buffersize)
+except KeyError: True
+
+# number of threads building and sending mails in the background
+delivery_workers = 2
+try:
+    delivery_workers = config['MAIL'].getint('delivery_workers', delivery_workers)
+except KeyError: True
+
+# a mail is spooled once and then sent to its relays in parallel, over up to
+# fanout_connections extra connections with at most fanout_batch recipients per transaction
+fanout_connections = 4
+try:
+    fanout_connections = config['MAIL'].getint('fanout_connections', fanout_connections)
+except KeyError: True
+
+fanout_batch = 50
+try:
+    fanout_batch = config['MAIL'].getint('fanout_batch', fanout_batch)
 except KeyError: True
 
 max_attachmentsize = 5
@@ -154,34 +252,112 @@ try:
     max_attachmentsize = config['MAIL']['max_attachmentsize']
 except KeyError: True
 
-autoreply = ""
+# attachments above max_attachmentsize: images are scaled down and recompressed (needs Pillow),
+# whatever still does not fit is copied to store_dir under its SHA-256 hash and referenced in the mail
+# ("store"), or left out ("drop")
+oversize_attachments = "store"
+try:
+    oversize_attachments = config['ATTACHMENTS'].get('oversize', oversize_attachments).strip().lower()
+except KeyError: True
+if oversize_attachments not in ("store", "drop"):
+    print("Configuration error -- [ATTACHMENTS] oversize must be store or drop, not " + oversize_attachments, file=sys.stderr)
+    raise SystemExit(1)
+
+recompress_images = True
+try:
+    recompress_images = config['ATTACHMENTS'].getboolean('recompress_images', recompress_images)
+except KeyError: True
+
+# longest side in pixels and JPEG quality of recompressed images
+image_maxsize = 2048
+try:
+    image_maxsize = config['ATTACHMENTS'].getint('image_maxsize', image_maxsize)
+except KeyError: True
+
+image_quality = 80
+try:
+    image_quality = config['ATTACHMENTS'].getint('image_quality', image_quality)
+except KeyError: True
+
+attachment_store = os.path.join(data_dir, "store", "")
+try:
+    attachment_store = os.path.join(os.path.expanduser(os.path.expandvars(config['ATTACHMENTS']['store_dir'])), "")
+except KeyError: True
+
+# prefix for the references in the mail, e.g. the URL a web server publishes store_dir under;
+# empty uses the local path
+attachment_store_url = ""
+try:
+    attachment_store_url = config['ATTACHMENTS'].get('store_url', attachment_store_url)
+except KeyError: True
+
+# processes working on oversize attachments, and MByte of attachments they may work on at the same time
+attachment_workers = 2
+try:
+    attachment_workers = config['ATTACHMENTS'].getint('workers', attachment_workers)
+except KeyError: True
+
+attachment_budget = 64
+try:
+    attachment_budget = config['ATTACHMENTS'].getint('memory_budget', attachment_budget)
+except KeyError: True
+
+# seconds between checks whether config_file changed, 0 reloads it on SIGHUP only
+config_reload = 10
+try:
+    config_reload = config['OTHER'].getint('config_reload', config_reload)
+except KeyError: True
+
+# contact and group names looked up over DBus are cached for name_ttl seconds,
+# keeping at most name_cachesize names
+name_ttl = 3600
+try:
+    name_ttl = config['CACHE'].getint('name_ttl', name_ttl)
+except KeyError: True
+
+name_cachesize = 1000
 try:
-    autoreply = config['OTHER']['autoreply']
+    name_cachesize = config['CACHE'].getint('name_cachesize', name_cachesize)
 except KeyError: True
 
-autoattach = ""
+# keep the name cache in data_dir across restarts
+persist_names = False
 try:
-    autoattach = config['OTHER']['autoattach']
+    persist_names = config['CACHE'].getboolean('persist', persist_names)
 except KeyError: True
 
-timeformat = "%Y-%m-%d %H:%M:%S %Z"
+# messages already forwarded are remembered, at most dedupe_entries of them
+# (0 switches this off) for dedupe_max_age seconds, so they are not sent twice
+dedupe_entries = 100000
 try:
-    timeformat = config['OTHER']['timeformat']
+    dedupe_entries = config['DEDUPE'].getint('entries', dedupe_entries)
 except KeyError: True
 
-contacts = []
+dedupe_max_age = 7 * 24 * 3600
 try:
-    contacts = config.items("CONTACTS")
+    dedupe_max_age = config['DEDUPE'].getint('max_age', dedupe_max_age)
 except KeyError: True
 
-exclude = []
+# per-stage timing metrics in Prometheus text format, written to textfile every
+# metrics_interval seconds and/or served on http://127.0.0.1:<http_port>/metrics
+metrics_enabled = False
 try:
-    exclude = config.items("EXCLUDE")
+    metrics_enabled = config['METRICS'].getboolean('enabled', metrics_enabled)
 except KeyError: True
 
-headers = []
+metrics_textfile = ""
 try:
-    headers = config.items("HEADERS")
+    metrics_textfile = config['METRICS'].get('textfile', metrics_textfile)
+except KeyError: True
+
+metrics_interval = 15
+try:
+    metrics_interval = config['METRICS'].getint('interval', metrics_interval)
+except KeyError: True
+
+metrics_port = 0
+try:
+    metrics_port = config['METRICS'].getint('http_port', metrics_port)
 except KeyError: True
 
 attachmentpath = os.path.join(os.path.expandvars(signalsettingspath), "attachments", "")
@@ -190,201 +366,1218 @@ attachmentpath = os.path.join(os.path.expandvars(signalsettingspath), "attachmen
 if args.no_sendmail: sendmail = False
 if args.debug: debug = True
 if args.keep_attachments: deleteattachments = False
-if args.no_autoreply: autoreply=""
 if args.system: sessiondbus = False
 if args.useAPIV2: APIV2 = True
-if args.signalnumber: signalnumber = args.signalnumber
 
-if debug: print("startup: APIV2 is", APIV2)
+# log level of all of signalmail and of single subsystems; debug switches everything
+# without a level of its own to DEBUG, --debug overrides the configured level
+logSubsystems = ("intake", "render", "attachments", "delivery", "smtp", "signal", "metrics")
+
+def parseLogLevel(option, value):
+    level = logging.getLevelName(value.strip().upper())
+    if not isinstance(level, int):
+        print("Configuration error -- " + option + " in [LOGGING] must be DEBUG, INFO, WARNING or ERROR, not " + value, file=sys.stderr)
+        raise SystemExit(1)
+    return level
+
+log_level = logging.DEBUG if debug else logging.INFO
+try:
+    if not args.debug:
+        log_level = parseLogLevel('level', config['LOGGING'].get('level', logging.getLevelName(log_level)))
+except KeyError: True
+
+log_levels = {}
+try:
+    for subsystem in logSubsystems:
+        if subsystem in config['LOGGING']:
+            log_levels[subsystem] = parseLogLevel(subsystem, config['LOGGING'][subsystem])
+except KeyError: True
+
+# only every log_sample-th record of each debug message is written (1 writes all)
+log_sample = 1
+try:
+    log_sample = config['LOGGING'].getint('sample', log_sample)
+except KeyError: True
+
+# records waiting for the log thread, more are dropped rather than holding up the caller
+log_queuesize = 10000
+
+# writes the first of every sample records of each debug message, counted by logger
+# and message template, so debug logging stays readable and cheap under load
+class SampleFilter(logging.Filter):
+    def __init__(self, sample):
+        super().__init__()
+        self.sample = sample
+        self.counts = collections.Counter() # (logger, template) -> records seen
+        self.maxkeys = 1000
+
+    def filter(self, record):
+        if self.sample <= 1 or record.levelno > logging.DEBUG:
+            return True
+        key = (record.name, record.msg)
+        if key not in self.counts and len(self.counts) >= self.maxkeys:
+            # messages logged without a template would grow it without bound
+            self.counts.clear()
+        self.counts[key] += 1
+        return self.counts[key] % self.sample == 1
+#end class SampleFilter
+
+# hands records to the log thread as they are, so their arguments are only formatted
+# there, and drops them when that thread falls behind
+class LogQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.count("signalmail_log_records_dropped_total")
+#end class LogQueueHandler
+
+# blanks out SMTP passwords, plain and base64 encoded as in AUTH LOGIN, and the
+# credentials of AUTH commands in smtplib's protocol trace
+class RedactingFormatter(logging.Formatter):
+    authPattern = re.compile(r"(send: .AUTH +\S+ +)\S+", re.IGNORECASE)
+
+    def __init__(self, fmt):
+        super().__init__(fmt)
+        # replaced, never changed, as the log thread formats while a reload adds passwords;
+        # longest first, so a password containing another one is blanked out as a whole
+        self.secrets = ()
+        self.lock = threading.Lock()
+
+    def addSecret(self, secret):
+        if secret:
+            with self.lock:
+                secrets = set(self.secrets) | {secret, base64.b64encode(secret.encode("utf-8")).decode("ascii")}
+                self.secrets = tuple(sorted(secrets, key=len, reverse=True))
+
+    def format(self, record):
+        text = self.authPattern.sub(r"\1****", super().format(record))
+        for secret in self.secrets:
+            text = text.replace(secret, "****")
+        return text
+#end class RedactingFormatter
+
+log = logging.getLogger("signalmail")
+intakeLog = logging.getLogger("signalmail.intake") # receiving, queueing, digests, spill, dedupe
+renderLog = logging.getLogger("signalmail.render") # names, mentions and templates
+attachmentLog = logging.getLogger("signalmail.attachments")
+deliveryLog = logging.getLogger("signalmail.delivery") # workers and outbox
+smtpLog = logging.getLogger("signalmail.smtp") # SMTP sessions and protocol trace
+signalLog = logging.getLogger("signalmail.signal") # DBus, JSON-RPC, contacts and autoreplies
+metricsLog = logging.getLogger("signalmail.metrics")
+
+# records are formatted and written to stderr by a thread of their own
+logFormatter = RedactingFormatter("%(levelname)s - %(threadName)s %(name)s %(funcName)s(): %(message)s")
+logHandler = logging.StreamHandler(sys.stderr)
+logHandler.setFormatter(logFormatter)
+logQueueHandler = LogQueueHandler(queue.Queue(log_queuesize))
+logQueueHandler.addFilter(SampleFilter(log_sample))
+log.addHandler(logQueueHandler)
+log.propagate = False
+log.setLevel(log_level)
+for subsystem, level in log_levels.items():
+    logging.getLogger("signalmail." + subsystem).setLevel(level)
+logListener = logging.handlers.QueueListener(logQueueHandler.queue, logHandler)
+logListener.start()
+atexit.register(logListener.stop)
+
+log.debug("startup: APIV2 is %s", APIV2)
+
+# placeholders available in mailfrom, mailsubject, bodyheading, mailsignature and [HEADERS]
+placeholders = ("senderId", "senderName", "groupId", "groupName", "timestamp")
+placeholderPattern = re.compile(r"\{(\w+)\}")
+
+# template parsed once into literal text and placeholders, rendered in a single pass
+class Template:
+    def __init__(self, name, text):
+        parts = placeholderPattern.split(text) # literal text at even, placeholder names at odd indexes
+        self.fields = set(parts[1::2])
+        unknown = self.fields.difference(placeholders)
+        if unknown:
+            raise ValueError("unknown placeholder {" + "}, {".join(sorted(unknown)) + "} in " + name
+                             + ", known placeholders are {" + "}, {".join(placeholders) + "}")
+        self.literals = parts[0::2]
+        self.names = parts[1::2]
+
+    def render(self, values):
+        if not self.names:
+            return self.literals[0]
+        result = [self.literals[0]]
+        for name, literal in zip(self.names, self.literals[1:]):
+            result.append(values[name])
+            result.append(literal)
+        return "".join(result)
+#end class Template
+
+# SMTP relay, either the one of an account or one of the [SMTP <name>] profiles
+class SMTPProfile:
+    def __init__(self, name, server, port, user, password, starttls,
+                 messagesPerMinute=0, recipientsPerHour=0, mailsPerRecipientPerHour=0, recipients=()):
+        self.name = name
+        self.server = server
+        self.port = port
+        self.user = user
+        self.password = password
+        logFormatter.addSecret(password)
+        self.starttls = starttls
+        self.messagesPerMinute = messagesPerMinute
+        self.recipientsPerHour = recipientsPerHour
+        self.mailsPerRecipientPerHour = mailsPerRecipientPerHour
+        self.recipients = recipients
+#end class SMTPProfile
+
+# mail settings and compiled templates for the messages a route applies to,
+# taken from a [ROUTE ...] section or, where missing, from the account
+class Route:
+    def __init__(self, name, account, section=None, exclude=False):
+        config = account.settings.config
+        def setting(option, default):
+            if section is None:
+                return default
+            return config.get(section, option, fallback=default)
+        prefix = "" if section is None else "[" + section + "] "
+        self.name = name
+        self.exclude = exclude or (section is not None and config.getboolean(section, 'exclude', fallback=False))
+        self.addr_list = setting('addr_list', account.addr_list)
+        self.mailfromTemplate = Template(prefix + "mailfrom", setting('mailfrom', account.mailfrom))
+        self.mailsubjectTemplate = Template(prefix + "mailsubject", setting('mailsubject', account.mailsubject))
+        self.bodyHeadingTemplate = Template(prefix + "bodyheading", setting('bodyheading', account.bodyHeading))
+        self.mailsignatureTemplate = Template(prefix + "mailsignature", setting('mailsignature', account.mailsignature))
+        self.headerTemplates = [(header, Template(header, headerValue)) for header, headerValue in account.settings.headers]
+        # only these placeholders are computed for each message
+        self.usedPlaceholders = set().union(self.mailfromTemplate.fields, self.mailsubjectTemplate.fields,
+            self.bodyHeadingTemplate.fields, self.mailsignatureTemplate.fields,
+            *(template.fields for header, template in self.headerTemplates))
+        profileName = setting('smtp', "")
+        if not profileName:
+            self.smtp = account.smtp
+        elif profileName in account.settings.smtpProfiles:
+            self.smtp = account.settings.smtpProfiles[profileName]
+        else:
+            raise ValueError("unknown SMTP profile '" + profileName + "' in [" + section + "]")
+#end class Route
+
+# routes of one account, indexed by group id and sender number:
+#   [ROUTE group <groupId>]  messages in this group (id as shown in X-Signal-Group-Id)
+#   [ROUTE sender <number>]  messages from this sender
+#   [ROUTE group *]          any other group message
+#   [ROUTE sender *]         any other direct message
+# senders in [EXCLUDE] always resolve to an excluding route
+class RoutingTable:
+    def __init__(self, account):
+        self.default = Route("default", account)
+        self.groups = {}
+        self.senders = {}
+        self.anyGroup = None
+        self.anySender = None
+        config = account.settings.config
+        for section in config.sections():
+            if not section.startswith("ROUTE "):
+                continue
+            words = section.split(None, 2)
+            if len(words) != 3 or words[1] not in ("group", "sender"):
+                raise ValueError("route section [" + section + "] must be [ROUTE group <groupId>] or [ROUTE sender <number>]")
+            kind, key = words[1], words[2].strip()
+            route = Route(kind + " " + key, account, section)
+            if kind == "group" and key == "*":
+                self.anyGroup = route
+            elif kind == "sender" and key == "*":
+                self.anySender = route
+            elif kind == "group":
+                self.groups[key] = route
+            else:
+                self.senders[key] = route
+        excluded = Route("exclude", account, exclude=True)
+        for number, comment in account.settings.exclude:
+            self.senders[number] = excluded
+
+    # groupIdEncoded is the base64 group id, empty for direct messages
+    def resolve(self, sender, groupIdEncoded):
+        route = self.senders.get(sender)
+        if route is not None and route.exclude:
+            return route
+        if groupIdEncoded:
+            return self.groups.get(groupIdEncoded) or route or self.anyGroup or self.default
+        return route or self.anySender or self.default
+#end class RoutingTable
+
+# one Signal number served by this process, with its default mail settings and routes
+class Account:
+    def __init__(self, settings, signalnumber, signalname, mailfrom, mailsubject, bodyHeading, mailsignature,
+                 addr_list, smtpserver, smtpport, smtpuser, smtppassword):
+        self.settings = settings
+        self.signalnumber = signalnumber
+        self.signalname = signalname
+        self.mailfrom = mailfrom
+        self.mailsubject = mailsubject
+        self.bodyHeading = bodyHeading
+        self.mailsignature = mailsignature
+        self.addr_list = addr_list
+        self.smtp = SMTPProfile("", smtpserver, smtpport, smtpuser, smtppassword, settings.smtpstarttls,
+                                settings.messages_per_minute, settings.recipients_per_hour, settings.mails_per_recipient_per_hour)
+        self.routes = RoutingTable(self)
+        self.signal_client = None # set by connectToDBus(), taken over on reload
+#end class Account
+
+# everything that can change while signalmail runs: accounts with their routes and
+# templates, SMTP relays, [CONTACTS], [EXCLUDE], [HEADERS], digest windows, timeformat
+# and autoreply. Built from a parsed config file and not changed afterwards; a reload
+# builds new Settings and swaps them in, messages already taken in keep theirs through
+# their account. Raises KeyError for a missing mandatory key, ValueError for bad values.
+class Settings:
+    def __init__(self, config):
+        self.config = config
+        #mandatory config variables
+        signalnumber = config['SIGNAL']['signalnumber']
+        signalname = config['SIGNAL']['signalname']
+        mailfrom = config['MAIL']['mailfrom']
+        mailsubject = config['MAIL']['mailsubject']
+        mailsignature = config['MAIL']['mailsignature']
+        bodyHeading = config['MAIL']['bodyheading']
+        addr_list = config['MAIL']['addr_list']
+        smtpserver = config['MAIL']['smtpserver']
+        smtpuser = config['MAIL']['smtpuser']
+        smtppassword = config['MAIL']['smtppassword']
+        if args.signalnumber: signalnumber = args.signalnumber
+
+        smtpport = config.get('MAIL', 'smtpport', fallback=587)
+        # upgrade SMTP connections with STARTTLS, only switch off for local relays
+        self.smtpstarttls = config.getboolean('MAIL', 'smtpstarttls', fallback=True)
+        # quotas of the relay, 0 for none: mails per minute, recipients per hour
+        # and mails per hour to any single recipient; [SMTP <name>] sections can set their own
+        self.messages_per_minute = config.getint('MAIL', 'messages_per_minute', fallback=0)
+        self.recipients_per_hour = config.getint('MAIL', 'recipients_per_hour', fallback=0)
+        self.mails_per_recipient_per_hour = config.getint('MAIL', 'mails_per_recipient_per_hour', fallback=0)
+
+        self.autoreply = "" if args.no_autoreply else config.get('OTHER', 'autoreply', fallback="")
+        self.autoattach = config.get('OTHER', 'autoattach', fallback="")
+        # seconds after an autoreply in which the same sender gets no further autoreply
+        # in the same group or direct chat, 0 replies to every message
+        self.autoreply_cooldown = config.getint('OTHER', 'autoreply_cooldown', fallback=3600)
+        self.timeformat = config.get('OTHER', 'timeformat', fallback="%Y-%m-%d %H:%M:%S %Z")
+
+        # digest mode: collect the messages of a group (or of a sender, for direct messages)
+        # for window seconds and forward them as one mail; 0 disables digest mode
+        self.digest_window = config.getint('DIGEST', 'window', fallback=0)
+        self.digest_max_messages = config.getint('DIGEST', 'max_messages', fallback=50)
+        # per group / sender overrides from [DIGEST <groupId or number>] sections
+        self.digestOverrides = {}
+        for section in config.sections():
+            if section.startswith("DIGEST "):
+                self.digestOverrides[section[len("DIGEST "):].strip()] = (
+                    config[section].getint('window', self.digest_window),
+                    config[section].getint('max_messages', self.digest_max_messages))
+
+        self.contacts = config.items("CONTACTS") if config.has_section("CONTACTS") else []
+        self.exclude = config.items("EXCLUDE") if config.has_section("EXCLUDE") else []
+        self.headers = config.items("HEADERS") if config.has_section("HEADERS") else []
+
+        # [SMTP <name>] sections, missing settings are taken from [MAIL]
+        self.smtpProfiles = {}
+        for section in config.sections():
+            if section.startswith("SMTP "):
+                name = section[len("SMTP "):].strip()
+                self.smtpProfiles[name] = SMTPProfile(name,
+                    config.get(section, 'smtpserver', fallback=smtpserver),
+                    config.get(section, 'smtpport', fallback=smtpport),
+                    config.get(section, 'smtpuser', fallback=smtpuser),
+                    config.get(section, 'smtppassword', fallback=smtppassword),
+                    config.getboolean(section, 'smtpstarttls', fallback=self.smtpstarttls),
+                    config.getint(section, 'messages_per_minute', fallback=self.messages_per_minute),
+                    config.getint(section, 'recipients_per_hour', fallback=self.recipients_per_hour),
+                    config.getint(section, 'mails_per_recipient_per_hour', fallback=self.mails_per_recipient_per_hour),
+                    [recipient.strip().lower() for recipient in config.get(section, 'recipients', fallback="").split(',') if recipient.strip()])
+
+        # recipient address or @domain -> the profile that delivers to it, whatever route the mail takes
+        self.recipientRelays = {}
+        for profile in self.smtpProfiles.values():
+            for recipient in profile.recipients:
+                if recipient in self.recipientRelays:
+                    raise ValueError("recipient " + recipient + " is in [SMTP " + self.recipientRelays[recipient].name + "] and [SMTP " + profile.name + "]")
+                self.recipientRelays[recipient] = profile
+
+        # the account from [SIGNAL]/[MAIL] comes first, every further account has a
+        # [SIGNAL <number>] section and optionally a [MAIL <number>] section,
+        # missing settings are taken from [SIGNAL] and [MAIL]
+        self.accounts = [Account(self, signalnumber, signalname, mailfrom, mailsubject, bodyHeading, mailsignature,
+                                 addr_list, smtpserver, smtpport, smtpuser, smtppassword)]
+        for section in config.sections():
+            if not section.startswith("SIGNAL "):
+                continue
+            number = section[len("SIGNAL "):].strip()
+            if number == signalnumber:
+                continue
+            mailSection = "MAIL " + number
+            self.accounts.append(Account(self, number,
+                config.get(section, 'signalname', fallback=signalname),
+                config.get(mailSection, 'mailfrom', fallback=mailfrom),
+                config.get(mailSection, 'mailsubject', fallback=mailsubject),
+                config.get(mailSection, 'bodyheading', fallback=bodyHeading),
+                config.get(mailSection, 'mailsignature', fallback=mailsignature),
+                config.get(mailSection, 'addr_list', fallback=addr_list),
+                config.get(mailSection, 'smtpserver', fallback=smtpserver),
+                config.get(mailSection, 'smtpport', fallback=smtpport),
+                config.get(mailSection, 'smtpuser', fallback=smtpuser),
+                config.get(mailSection, 'smtppassword', fallback=smtppassword)))
+        self.accountsByNumber = {account.signalnumber: account for account in self.accounts}
+
+    # groups the recipients by relay: the profile listing the address or its @domain, otherwise smtp
+    def splitRecipients(self, smtp, to_addrs):
+        deliveries = {}
+        for to_addr in to_addrs:
+            address = to_addr.strip()
+            if not address:
+                continue
+            key = address.lower()
+            if "<" in key:
+                key = key[key.rindex("<") + 1:].rstrip(">")
+            profile = self.recipientRelays.get(key) or self.recipientRelays.get("@" + key.rpartition("@")[2]) or smtp
+            deliveries.setdefault(profile.name, []).append(address)
+        return [{"smtp": name, "to": addresses} for name, addresses in deliveries.items()]
+#end class Settings
+
+# the settings in force, only ever replaced as a whole by reloadSettings()
+try:
+    settings = Settings(config)
+except KeyError as key:
+    print("Configuration error -- " + config_file + " incomplete, missing key " + str(key) + ".", file=sys.stderr)
+    raise SystemExit(1)
+except ValueError as error:
+    print("Configuration error -- " + str(error), file=sys.stderr)
+    raise SystemExit(1)
+
+# measures one stage, see Metrics.timer()
+class StageTimer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+# counters, gauges and per-stage latency histograms
+class Metrics:
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(int) # name -> value
+        self.histograms = {} # stage -> [bucket counts..., count, sum]
+        self.gauges = {} # name -> function returning the current value
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[index] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    # with metrics.timer("smtp"): ...
+    def timer(self, stage):
+        return StageTimer(self, stage)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((stage, list(histogram)) for stage, histogram in self.histograms.items())
+        for name, value in counters:
+            lines.append("# TYPE " + name + " counter")
+            lines.append(name + " " + str(value))
+        for name, function in sorted(self.gauges.items()):
+            lines.append("# TYPE " + name + " gauge")
+            lines.append(name + " " + str(function()))
+        if histograms:
+            lines.append("# HELP signalmail_stage_seconds time spent per processing stage")
+            lines.append("# TYPE signalmail_stage_seconds histogram")
+        for stage, histogram in histograms:
+            for bound, bucketCount in zip(self.buckets, histogram):
+                lines.append('signalmail_stage_seconds_bucket{stage="' + stage + '",le="' + str(bound) + '"} ' + str(bucketCount))
+            lines.append('signalmail_stage_seconds_bucket{stage="' + stage + '",le="+Inf"} ' + str(histogram[-2]))
+            lines.append('signalmail_stage_seconds_count{stage="' + stage + '"} ' + str(histogram[-2]))
+            lines.append('signalmail_stage_seconds_sum{stage="' + stage + '"} ' + repr(histogram[-1]))
+        return "\n".join(lines) + "\n"
+#end class Metrics
+
+# stands in for Metrics when they are switched off, so instrumentation costs a method call
+class NoStageTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+class NoMetrics:
+    noTimer = NoStageTimer()
+
+    def count(self, name, value=1):
+        pass
+
+    def gauge(self, name, function):
+        pass
+
+    def observe(self, stage, seconds):
+        pass
+
+    def timer(self, stage):
+        return self.noTimer
+#end class NoMetrics
+
+metrics = Metrics() if metrics_enabled else NoMetrics()
+
+def writeMetricsTextfile():
+    while True:
+        try:
+            with open(metrics_textfile + ".tmp", "w", encoding="utf-8") as fp:
+                fp.write(metrics.render())
+            os.replace(metrics_textfile + ".tmp", metrics_textfile)
+        except OSError as e:
+            metricsLog.error("Cannot write metrics to %s: %r", metrics_textfile, e)
+        time.sleep(metrics_interval)
+
+def startMetrics():
+    if not metrics_enabled:
+        return
+    metrics.gauge("signalmail_delivery_queue_depth", deliveryQueue.qsize)
+    metrics.gauge("signalmail_spilled_messages", lambda: spill.waiting)
+    metrics.gauge("signalmail_outbox_pending", lambda: len(outbox.pending))
+    metrics.gauge("signalmail_digest_buffers", lambda: len(digestBuffers))
+    if metrics_textfile:
+        threading.Thread(target=writeMetricsTextfile, name="metrics-textfile", daemon=True).start()
+        metricsLog.debug("writing metrics to %s", metrics_textfile)
+    if metrics_port:
+        import http.server # only needed for the endpoint
+
+        class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                metricsLog.debug("metrics endpoint: " + format, *args)
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", metrics_port), MetricsRequestHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        metricsLog.debug("serving metrics on http://127.0.0.1:%d/metrics", metrics_port)
 
 # main program:
 def main():
-    if debug: print("DEBUG - main(): called")
-    if debug: print("signalmail v" + version + ", Timestamp: " + str(datetime.datetime.now()))
-    if debug: print("Switch settings: debug = " + str(debug) +  ", sendmail = " + str(sendmail) + ", deleteattachments = " + str(deleteattachments) + ", sessiondbus = " + str(sessiondbus) + ", APIV2 = " + str(APIV2) + ", autoreply = " + str(autoreply))
-    if debug:
-        if autoreply: print("autoreply=" + autoreply)
-    if debug:
-        if autoattach: print("autoattach = " + autoattach)
-    if debug: print("data_dir=",data_dir)
+    log.debug("called")
+    log.debug("signalmail v%s, Timestamp: %s", version, datetime.datetime.now())
+    log.debug("Switch settings: debug = %s, sendmail = %s, deleteattachments = %s, sessiondbus = %s, APIV2 = %s, autoreply = %s",
+              debug, sendmail, deleteattachments, sessiondbus, APIV2, settings.autoreply)
+    if settings.autoattach: log.debug("autoattach = %s", settings.autoattach)
+    log.debug("data_dir = %s", data_dir)
 
 
-    loop = GLib.MainLoop()
+    log.debug("accounts: %s", ", ".join(account.signalnumber for account in settings.accounts))
 
-    global signal_client
-    signal_client = connectToDBus()
+    if args.ingest:
+        ingest(args.ingest)
+        return
 
+    # one main loop and one bus or socket connection for all accounts,
+    # listen first, contacts are configured in the background
+    if signal_transport == "jsonrpc":
+        connection = connectToJsonRpc(settings.accounts, partial(callbackLoop.post, receiveEnvelope))
+    else:
+        if GLib is None:
+            print("Configuration error -- transport dbus needs pydbus and PyGObject, install them or use transport = jsonrpc", file=sys.stderr)
+            raise SystemExit(1)
+        loop = GLib.MainLoop()
+        connectToDBus(settings.accounts)
+        for account in settings.accounts:
+            subscribeSignals(account)
+
+    if persist_names:
+        nameCache.load(nameCacheFile)
+
+    dedupe.load()
+    outbox.load()
+    outbox.start()
+    spill.start()
+    startDeliveryWorkers()
+    startAutoreply()
+    startMetrics()
+    threading.Thread(target=syncContacts, name="contacts", daemon=True).start()
+    startConfigWatch()
+
+    try:
+        if signal_transport == "jsonrpc":
+            callbackLoop.run()
+        else:
+            loop.run()
+    finally:
+        if signal_transport == "jsonrpc":
+            connection.onReceive = None
+        # deliver what is already queued before giving up the SMTP sessions
+        for bufferKey in list(digestBuffers):
+            flushDigest(bufferKey, block=True)
+        deliveryQueue.join()
+        dedupe.close()
+        shutdownAttachmentPool()
+        closeSMTPSessions()
+        if persist_names:
+            nameCache.save(nameCacheFile)
+
+    log.debug("finished")
+# end main()
+
+# --ingest reads this many envelopes at a time and looks up their names
+# with this many parallel DBus calls before queueing them
+ingest_batchsize = 200
+ingest_lookups = 8
+
+# forwards the messages of signal-cli JSON output, one envelope per line, through the
+# routes, outbox and delivery workers; lines are read batch by batch and the bounded
+# delivery queue holds back reading, so memory does not grow with the file.
+# Digest windows and autoreplies do not apply.
+def ingest(path):
+    if args.offline:
+        for account in settings.accounts:
+            account.signal_client = EnvelopeNames()
+    elif signal_transport == "jsonrpc":
+        connectToJsonRpc(settings.accounts)
+    else:
+        connectToDBus(settings.accounts)
+    if persist_names and not args.offline:
+        nameCache.load(nameCacheFile)
+    dedupe.load()
+    outbox.load()
+    outbox.start()
+    startDeliveryWorkers()
+    startMetrics()
+
+    counts = collections.Counter()
+    fp = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    lookups = futures.ThreadPoolExecutor(max_workers=ingest_lookups, thread_name_prefix="lookup")
+    try:
+        batch = []
+        for lineNumber, line in enumerate(fp, 1):
+            if not line.strip():
+                continue
+            try:
+                job = parseEnvelope(json.loads(line))
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                counts["broken"] += 1
+                intakeLog.error("Cannot read line %d of %s: %r", lineNumber, path, e)
+                continue
+            if job is None:
+                counts["skipped"] += 1
+                continue
+            batch.append(job)
+            if len(batch) >= ingest_batchsize:
+                ingestBatch(batch, lookups, counts)
+                batch = []
+        ingestBatch(batch, lookups, counts)
+    finally:
+        if fp is not sys.stdin:
+            fp.close()
+        lookups.shutdown()
+        deliveryQueue.join()
+        dedupe.close()
+        shutdownAttachmentPool()
+        closeSMTPSessions()
+        if persist_names and not args.offline:
+            nameCache.save(nameCacheFile)
+    print("ingested " + str(counts["queued"]) + " messages from " + path + ", " + str(counts["excluded"]) + " excluded, "
+          + str(counts["duplicate"]) + " already forwarded, "
+          + str(counts["skipped"]) + " envelopes without message, " + str(counts["broken"]) + " unreadable lines, "
+          + str(len(outbox.pending)) + " mails left in " + outbox.directory)
+
+# returns (account, timestamp, sender, groupId, message, extras) like msgRcvV2 gets them,
+# None for envelopes without a message (receipts, typing, sync messages, ...)
+def parseEnvelope(record):
+    current = settings
+    account = current.accountsByNumber.get(record.get("account"), current.accounts[0])
+    envelope = record.get("envelope", record)
+    dataMessage = envelope.get("dataMessage")
+    sender = envelope.get("sourceNumber") or envelope.get("source")
+    if not dataMessage or not sender:
+        return None
+    message = dataMessage.get("message") or ""
+    attachmentList = []
+    for attachment in dataMessage.get("attachments") or []:
+        attachmentFile = attachment.get("file") or attachmentpath + str(attachment["id"])
+        size = attachment.get("size")
+        if size is None:
+            size = os.path.getsize(attachmentFile) if os.path.exists(attachmentFile) else 0
+        attachmentList.append({"file": attachmentFile, "contentType": attachment.get("contentType") or "application/octet-stream",
+                               "fileName": attachment.get("filename") or "", "size": size})
+    if not message and not attachmentList:
+        return None
+    mentionList = []
+    for mention in dataMessage.get("mentions") or []:
+        number = mention.get("number") or mention.get("uuid")
+        if not number:
+            # nobody to name, the placeholder character stays in the text
+            continue
+        mentionList.append({"recipient": number, "start": mention["start"], "length": mention["length"]})
+        if args.offline and mention.get("name"):
+            account.signal_client.learnContact(number, mention["name"])
+    groupInfo = dataMessage.get("groupInfo") or {}
+    groupId = list(base64.b64decode(groupInfo["groupId"])) if groupInfo.get("groupId") else []
+    if args.offline:
+        account.signal_client.learnContact(sender, envelope.get("sourceName") or "")
+        if groupId and groupInfo.get("groupName"):
+            account.signal_client.learnGroup(groupId, groupInfo["groupName"])
+    timestamp = dataMessage.get("timestamp") or envelope["timestamp"]
+    return account, timestamp, sender, groupId, message, {"mentions": mentionList, "attachments": attachmentList}
+
+def ingestBatch(batch, lookups, counts):
+    jobs = []
+    names = set()
+    for account, timestamp, sender, groupId, message, extras in batch:
+        metrics.count("signalmail_messages_received_total")
+        if dedupe.seen(account, timestamp, sender, groupId):
+            metrics.count("signalmail_messages_duplicate_total")
+            counts["duplicate"] += 1
+            continue
+        groupIdEncoded = base64.b64encode(bytes(groupId)).decode("utf-8") if groupId else ""
+        route = account.routes.resolve(sender, groupIdEncoded)
+        if route.exclude:
+            metrics.count("signalmail_messages_excluded_total")
+            counts["excluded"] += 1
+            continue
+        jobs.append((account, route, (timestamp, sender, groupId, message, extras)))
+        # the names this batch needs, each looked up once
+        if "senderName" in route.usedPlaceholders:
+            names.add((getContactName, account, sender))
+        if groupId and "groupName" in route.usedPlaceholders:
+            names.add((getGroupName, account, tuple(groupId)))
+        for mention in extras["mentions"]:
+            names.add((getContactName, account, mention["recipient"]))
+    if not args.offline:
+        for future in [lookups.submit(lookup, account, list(key) if isinstance(key, tuple) else key) for lookup, account, key in names]:
+            try:
+                future.result()
+            except Exception as e:
+                intakeLog.debug("name lookup failed: %r", e)
+    for account, route, job in jobs:
+        # blocks while the queue is full
+        deliveryQueue.put((account, route, [job]))
+        counts["queued"] += 1
+    intakeLog.debug("queued %d messages, %d names looked up", len(jobs), len(names))
+
+# stands in for signal-cli with --ingest --offline, knowing the names seen in the
+# messages; names from [CONTACTS] take precedence
+class EnvelopeNames:
+    def __init__(self):
+        self.contacts = {}
+        self.groups = {}
+        self.configured = dict(settings.contacts)
+
+    def learnContact(self, number, name):
+        if name:
+            self.contacts[number] = name
+
+    def learnGroup(self, groupId, name):
+        self.groups[bytes(groupId)] = name
+
+    def getContactName(self, number):
+        return self.configured.get(number) or self.contacts.get(number, "")
+
+    def getGroupName(self, groupId):
+        return self.groups.get(bytes(groupId), "")
+#end class EnvelopeNames
+
+# names of [CONTACTS] already applied, per account, so a restart only touches changed entries
+contactsSnapshotFile = os.path.join(data_dir, "contacts.json")
+
+# runs in its own thread after the handlers are registered
+def syncContacts():
+    try:
+        with open(contactsSnapshotFile, "r", encoding="utf-8") as fp:
+            snapshot = json.load(fp)
+    except FileNotFoundError:
+        snapshot = {}
+    except (OSError, ValueError) as e:
+        signalLog.error("Cannot read contacts snapshot %s: %r", contactsSnapshotFile, e)
+        snapshot = {}
+    for account in settings.accounts:
+        try:
+            snapshot[account.signalnumber] = configureContacts(account, snapshot.get(account.signalnumber, {}))
+        except Exception as e:
+            signalLog.error("Cannot configure contacts for %s: %r", account.signalnumber, e)
+    try:
+        with open(contactsSnapshotFile + ".tmp", "w", encoding="utf-8") as fp:
+            json.dump(snapshot, fp)
+        os.replace(contactsSnapshotFile + ".tmp", contactsSnapshotFile)
+    except OSError as e:
+        signalLog.error("Cannot write contacts snapshot %s: %r", contactsSnapshotFile, e)
+    signalLog.debug("finished")
+
+# applies the [CONTACTS] names that differ from applied (number -> name of the last run),
+# returns the names now applied
+def configureContacts(account, applied):
+    signal_client = account.signal_client
+    configured = {}
     # contacts lookup:
     # check if number is known:
-    if contacts:
-        if debug: print("DEBUG - configuring contacts")
-        for contactNumber, contactName in contacts:
+    if account.settings.contacts:
+        signalLog.debug("configuring contacts for %s", account.signalnumber)
+        for contactNumber, contactName in account.settings.contacts:
+            if applied.get(contactNumber) == contactName:
+                # set before, signal-cli has the name; warm the cache all the same
+                configured[contactNumber] = contactName
+                nameCache.put(contactKey(account, contactNumber), contactName)
+                continue
             dbusName = signal_client.getContactName(contactNumber)
             if not contactName == dbusName:
                 try:
-                    signal_client.setContactName(contactNumber, contactName)
-                    if debug: print("DEBUG - set contact name for " + contactNumber + " to " + contactName)
+                    setContactName(account, contactNumber, contactName)
+                    configured[contactNumber] = contactName
+                    signalLog.debug("set contact name for %s to %s", contactNumber, contactName)
                 except:
-                    if debug: print("DEBUG - unable to set contact name for " + contactNumber + " to configured value " + contactName)
+                    nameCache.put(contactKey(account, contactNumber), dbusName)
+                    signalLog.debug("unable to set contact name for %s to configured value %s", contactNumber, contactName)
             else:
-                if debug: print("DEBUG - contact name " + contactName + " for " + contactNumber + " is already configured")
+                configured[contactNumber] = contactName
+                nameCache.put(contactKey(account, contactNumber), dbusName)
+                signalLog.debug("contact name %s for %s is already configured", contactName, contactNumber)
     else:
-        if debug: print("DEBUG - no contacts!")
+        signalLog.debug("no contacts!")
 
     # finally add the own number if not already there
-    if signalname:
-        selfName = signal_client.getContactName(signalnumber)
+    if account.signalname:
+        selfName = signal_client.getContactName(account.signalnumber)
         if not selfName:
-            signal_client.setContactName(signalnumber, signalname)
-            if debug: print("DEBUG - set own display name to '" + signalname + "'.")
+            setContactName(account, account.signalnumber, account.signalname)
+            signalLog.debug("set own display name to '%s'.", account.signalname)
         else:
-            if debug: print("DEBUG - own display name already configured as '" + signalname + "'.")
-
-    signal_client.onMessageReceivedV2 = msgRcvV2
-    signal_client.onMessageReceived = msgRcv
-    signal_client.onReceiptReceived = rcptRcv
-    signal_client.onReceiptReceivedV2 = rcptRcvV2
-    signal_client.onSyncMessageReceived = syncRcv
-    signal_client.onSyncMessageReceivedV2 = syncRcvV2
-
-    loop.run()
-
-    if debug: print("DEBUG - main(): finished")
-# end main()
-
-def msgRcv (timestamp, sender, groupId, message, attachmentList):
-    global APIV2
-    if APIV2: return
-    if debug: print("msgRcv called")
-    if debug: print("timestamp: ", timestamp, " sender: ", sender, " groupId: ", groupId, " message: ", message, " attachmentList: ", attachmentList)
-    msgRcvV2 (timestamp, sender, groupId, message, {"attachments":  attachmentList})
-
-def msgRcvV2 (timestamp, sender, groupId, message, extras):
-    global headers
-    global signal_client
+            signalLog.debug("own display name already configured as '%s'.", account.signalname)
+    return configured
+#end configureContacts(account, applied)
+
+# every subscription adds a match rule for its signal on the bus, signals without
+# one are dropped by the bus daemon and never wake signalmail. Receipts and sync
+# messages are only logged, so they are only subscribed to when debugging intake.
+# DBus match rules cannot leave out excluded senders, those still reach msgRcvV2.
+def subscribeSignals(account):
+    signal_client = account.signal_client
+    debugIntake = intakeLog.isEnabledFor(logging.DEBUG)
+    signal_client.onMessageReceivedV2 = partial(dbusMsgRcvV2, account)
+    if debugIntake:
+        signal_client.onReceiptReceivedV2 = rcptRcvV2
+        signal_client.onSyncMessageReceivedV2 = syncRcvV2
+    if not APIV2:
+        # older signal-cli versions only send these, newer ones send both;
+        # useAPIV2() drops them once a V2 signal arrived
+        signal_client.onMessageReceived = partial(msgRcv, account)
+        if debugIntake:
+            signal_client.onReceiptReceived = rcptRcv
+            signal_client.onSyncMessageReceived = syncRcv
+        legacySignalClients.append(signal_client)
+
+# signal clients still subscribed to the V1 signals
+legacySignalClients = []
+
+def useAPIV2():
     global APIV2
     APIV2 = True
-    if debug: print("msgRcvV2 called")
-
-    if sender in config["EXCLUDE"]:
-        if debug: print('DEBUG - excluding ' + sender)
+    signalLog.debug("signal-cli sends V2 signals, unsubscribing from V1 signals")
+    while legacySignalClients:
+        signal_client = legacySignalClients.pop()
+        signal_client.onMessageReceived = None
+        if signal_client.onReceiptReceived:
+            signal_client.onReceiptReceived = None
+        if signal_client.onSyncMessageReceived:
+            signal_client.onSyncMessageReceived = None
+
+# MessageReceivedV2 from DBus: only V2 signals show that signal-cli sends them,
+# msgRcv hands V1 messages to msgRcvV2 as well
+def dbusMsgRcvV2 (account, timestamp, sender, groupId, message, extras):
+    if not APIV2: useAPIV2()
+    msgRcvV2(account, timestamp, sender, groupId, message, extras)
+
+def msgRcv (account, timestamp, sender, groupId, message, attachmentList):
+    global APIV2
+    if APIV2: return
+    intakeLog.debug("msgRcv called")
+    intakeLog.debug("timestamp: %s sender: %s groupId: %s message: %s attachmentList: %s", timestamp, sender, groupId, message, attachmentList)
+    msgRcvV2 (account, timestamp, sender, groupId, message, {"attachments":  attachmentList})
+
+# runs in the main loop: only capture the message, the delivery workers do the rest
+def msgRcvV2 (account, timestamp, sender, groupId, message, extras):
+    # handlers stay bound to the account they were registered for, the message
+    # is handled with the settings in force now and keeps them until it is sent
+    account = settings.accountsByNumber.get(account.signalnumber, account)
+    intakeLog.debug("msgRcvV2 called for %s", account.signalnumber)
+    metrics.count("signalmail_messages_received_total")
+    if dedupe.seen(account, timestamp, sender, groupId):
+        intakeLog.debug("dropping message %s from %s, already forwarded", timestamp, sender)
+        metrics.count("signalmail_messages_duplicate_total")
         return
 
-    # de- and encode some of the given arguments to more convenient formats
-    mentionList = extras.get("mentions", [])
-    attachmentList = extras.get("attachments", [])
-    groupIdEncoded = base64.b64encode(bytes(groupId)).decode("utf-8")
+    if groupId:
+        groupIdEncoded = base64.b64encode(bytes(groupId)).decode("utf-8")
+    else:
+        groupIdEncoded = ""
+    route = account.routes.resolve(sender, groupIdEncoded)
+    if route.exclude:
+        intakeLog.debug("excluding %s (route %s)", sender, route.name)
+        metrics.count("signalmail_messages_excluded_total")
+        return
 
-    if debug: print("timestamp: ", timestamp, " sender: ", sender, " groupId: ", groupId, " message: ", message, " attachmentList: ", attachmentList)
-    if debug: print("mentionList: ", mentionList)
-    if debug: print("extras: ", extras)
-    if debug: print("groupId: ", groupIdEncoded)
+    if account.settings.autoreply and sender:
+        queueAutoreply(account, sender, groupIdEncoded)
 
-    if groupId:
-        groupName = signal_client.getGroupName(groupId)
+    job = (timestamp, sender, groupId, message, extras)
+    digestKey = groupIdEncoded or sender
+    window, maxMessages = account.settings.digestOverrides.get(digestKey, (account.settings.digest_window, account.settings.digest_max_messages))
+    if window > 0:
+        addToDigest(account, route, digestKey, window, maxMessages, job)
     else:
-        groupName = ""
+        enqueue(account, route, [job])
+        if intakeLog.isEnabledFor(logging.DEBUG):
+            intakeLog.debug("queued message, queue size is %d", deliveryQueue.qsize())
+#end msgRcvV2
+
+# every item is an account, the route and a list of messages to forward in one mail,
+# shared by all accounts
+deliveryQueue = queue.Queue(max(queue_size, 0))
 
-    if autoreply and sender:
-        if debug:
-            print("DEBUG - msgRcvV2(): sending autoreply '" + autoreply + "' and attachment '" + autoattach + "' to sender '" + sender + "'")
+# hands messages to the delivery workers, applying queue_policy when the queue is full;
+# called from the main loop
+def enqueue(account, route, messages):
+    if queue_policy == "block":
+        deliveryQueue.put((account, route, messages))
+        return
+    try:
+        deliveryQueue.put_nowait((account, route, messages))
+        return
+    except queue.Full:
+        metrics.count("signalmail_queue_overflows_total")
+    if queue_policy == "coalesce":
+        timestamp, sender, groupId, message, extras = messages[0]
+        digestKey = base64.b64encode(bytes(groupId)).decode("utf-8") if groupId else sender
+        bufferKey = (account.signalnumber, route.name, digestKey)
+        if bufferKey not in digestBuffers:
+            sourceId = addTimer(max(coalesce_window, 1), flushDigest, bufferKey)
+            digestBuffers[bufferKey] = (account, route, [], sourceId)
+        digestBuffers[bufferKey][2].extend(messages)
+        intakeLog.debug("queue full, coalescing %d messages for %s", len(messages), digestKey)
+    else:
+        spill.add(account, route, messages)
+
+# digest buffers, only touched from the main loop:
+# (account number, route name, group id or sender) -> (account, route, messages, timer source id)
+digestBuffers = {}
+
+def addToDigest(account, route, digestKey, window, maxMessages, job):
+    bufferKey = (account.signalnumber, route.name, digestKey)
+    if bufferKey not in digestBuffers:
+        sourceId = addTimer(window, flushDigest, bufferKey)
+        digestBuffers[bufferKey] = (account, route, [], sourceId)
+        intakeLog.debug("started digest for %s, sending in %d seconds", digestKey, window)
+    messages = digestBuffers[bufferKey][2]
+    messages.append(job)
+    if len(messages) >= maxMessages:
+        removeTimer(digestBuffers[bufferKey][3])
+        flushDigest(bufferKey)
+
+# timer callback, hands the collected messages to the delivery workers;
+# block waits for room in the queue instead of applying queue_policy
+def flushDigest(bufferKey, block=False):
+    account, route, messages, sourceId = digestBuffers.pop(bufferKey, (None, None, [], None))
+    if messages:
+        if block:
+            deliveryQueue.put((account, route, messages))
+        else:
+            enqueue(account, route, messages)
+        intakeLog.debug("queued %d messages for %s", len(messages), bufferKey[2])
+    return False # one-shot timer
+
+# messages that did not fit into the delivery queue, one JSON file per queue item in
+# data_dir/spill/, fed back oldest first as the workers catch up; left over files are
+# picked up on the next start
+class Spill:
+    def __init__(self, directory):
+        self.directory = directory
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+        self.waiting = 0
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with self.condition:
+            self.waiting = len([filename for filename in os.listdir(self.directory) if filename.endswith(".json")])
+        feeder = threading.Thread(target=self.run, name="spill", daemon=True)
+        feeder.start()
+
+    def add(self, account, route, messages):
+        path = os.path.join(self.directory, "%020d-%06d.json" % (time.time_ns(), next(self.counter)))
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path + ".tmp", "w", encoding="utf-8") as fp:
+                json.dump({"account": account.signalnumber, "messages": messages}, fp)
+            os.replace(path + ".tmp", path)
+        except (OSError, TypeError, ValueError) as e:
+            intakeLog.error("Cannot spill message to %s, waiting for the delivery queue: %r", path, e)
+            deliveryQueue.put((account, route, messages))
+            return
+        metrics.count("signalmail_messages_spilled_total")
+        with self.condition:
+            self.waiting += 1
+            self.condition.notify()
+        intakeLog.debug("queue full, spilled %d messages to %s", len(messages), path)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.waiting:
+                    self.condition.wait()
+            filenames = sorted(filename for filename in os.listdir(self.directory) if filename.endswith(".json"))
+            if not filenames:
+                with self.condition:
+                    self.waiting = 0
+                continue
+            for filename in filenames:
+                path = os.path.join(self.directory, filename)
+                try:
+                    with open(path, "r", encoding="utf-8") as fp:
+                        item = json.load(fp)
+                    current = settings
+                    account = current.accountsByNumber.get(item["account"], current.accounts[0])
+                    messages = []
+                    for timestamp, sender, groupId, message, extras in item["messages"]:
+                        # JSON has no tuples, but attachments of the old DBus API are
+                        extras["attachments"] = [tuple(attachment) if isinstance(attachment, list) else attachment
+                                                 for attachment in extras.get("attachments", [])]
+                        messages.append((timestamp, sender, groupId, message, extras))
+                    # blocks until a worker makes room
+                    deliveryQueue.put((account, account.routes.resolve(*routeKey(messages)), messages))
+                except (OSError, ValueError, KeyError) as e:
+                    intakeLog.error("Cannot read spilled messages %s: %r", path, e)
+                try:
+                    os.remove(path)
+                except FileNotFoundError: True
+                with self.condition:
+                    self.waiting = max(self.waiting - 1, 0)
+#end class Spill
+
+spill = Spill(os.path.join(data_dir, "spill", ""))
+
+# sender and encoded group id of the first message, to find the route of spilled messages again
+def routeKey(messages):
+    timestamp, sender, groupId, message, extras = messages[0]
+    return sender, base64.b64encode(bytes(groupId)).decode("utf-8") if groupId else ""
+
+# autoreplies are sent by their own thread, so neither the main loop nor the
+# delivery workers wait for signal-cli; (account number, group id, sender) -> monotonic
+# time of the last autoreply, only touched from the main loop
+autoreplyQueue = queue.Queue(100)
+autoreplyTimes = collections.OrderedDict()
+
+def queueAutoreply(account, sender, groupIdEncoded):
+    key = (account.signalnumber, groupIdEncoded, sender)
+    autoreply_cooldown = account.settings.autoreply_cooldown
+    now = time.monotonic()
+    # forget the oldest replies once their cooldown is over
+    while autoreplyTimes and next(iter(autoreplyTimes.values())) + autoreply_cooldown <= now:
+        autoreplyTimes.popitem(last=False)
+    if key in autoreplyTimes:
+        metrics.count("signalmail_autoreplies_suppressed_total")
+        signalLog.debug("%s got an autoreply less than %d seconds ago", sender, autoreply_cooldown)
+        return
+    try:
+        autoreplyQueue.put_nowait((account, sender))
+    except queue.Full:
+        metrics.count("signalmail_autoreplies_dropped_total")
+        signalLog.error("Cannot send autoreply to %s, too many autoreplies waiting", sender)
+        return
+    if autoreply_cooldown > 0:
+        autoreplyTimes[key] = now
+
+# started even without autoreply, a reload can switch it on
+def startAutoreply():
+    threading.Thread(target=autoreplyWorker, name="autoreply", daemon=True).start()
+
+def autoreplyWorker():
+    while True:
+        account, sender = autoreplyQueue.get()
+        autoreply = account.settings.autoreply
+        autoattach = account.settings.autoattach
+        signalLog.debug("sending autoreply '%s' and attachment '%s' to sender '%s'", autoreply, autoattach, sender)
         try:
-            signal_client.sendMessage(autoreply, [autoattach], sender)
+            with metrics.timer("autoreply"):
+                # signal-cli uploads the attachment again with every message, DBus offers no way to reuse it
+                account.signal_client.sendMessage(autoreply, [autoattach] if autoattach else [], sender)
+            metrics.count("signalmail_autoreplies_sent_total")
         except Exception as e:
-            print("Unexpected error:", sys.exc_info()[0])
-            print("Cannot send autoreply", file=sys.stderr)
-            print(e, " ", type(e), file=sys.stderr)
-            print("signal-desktop might be running")
+            signalLog.error("Cannot send autoreply, signal-desktop might be running: %r", e)
 
-    try:
-        sendername = signal_client.getContactName(sender)
-    except:
-        sendername = "unknown"
-    if debug: print("DEBUG - msgRcvV2() - Message - sender name: " + sendername)
+def startDeliveryWorkers():
+    for number in range(max(delivery_workers, 1)):
+        worker = threading.Thread(target=deliveryWorker, name="delivery-" + str(number), daemon=True)
+        worker.start()
+    deliveryLog.debug("started %d delivery workers", max(delivery_workers, 1))
 
-    #expand mentions
-    #objectReplacementCharacter is Unicode U+FFFC
-    #  or \xEF\xBF\xBC in UTF-8
-    #objectReplacementCharacter = b'\xEF\xBF\xBC'.decode("utf-8")
-    if mentionList:
-        lastindex = 0
-        newmessage = ""
-        for mention in mentionList:
-            if isinstance(mention, dict):
-                number = mention["recipient"]
-                position = mention["start"]
-                length = mention["length"]
-            else:
-                number = mention[0]
-                position = mention[1]
-                length = mention[2]
-            messagepart = message[lastindex:position]
-            name = signal_client.getContactName(number)
-            newmessage += messagepart + "@" + number
-            if name:
-                newmessage += " (" + name + ")"
-            lastindex = position + length
-            if debug: print("DEBUG - msgRcvV2() building message:", newmessage)
-        if (lastindex <= len(message)):
-            newmessage += message[lastindex:]
-        message = newmessage
-        if debug: print("DEBUG - msgRcvV2() final message is:", message)
-
-    # timestamp includes milliseconds, we have to strip them:
-    timestamp = datetime.datetime.fromtimestamp(float(str(timestamp)[0:-3]), getLocalTimezone())
-
-    replacements = {
-        "{senderId}": sender,
-        "{senderName}": sendername,
-        "{groupId}": groupIdEncoded,
-        "{groupName}": groupName,
-        "{timestamp}": timestamp.strftime(timeformat),
-    }
-    mailtext = replacePlaceholders(bodyHeading, replacements) + "\n" \
-        + message \
-        + "\n\n-- \n" + replacePlaceholders(mailsignature, replacements)
-    if debug: print("## Message :")
-    if debug: print(mailtext)
-    if debug: print("## end of message")
+def deliveryWorker():
+    while True:
+        account, route, messages = deliveryQueue.get()
+        try:
+            processMessages(account, route, messages)
+        except Exception as e:
+            metrics.count("signalmail_forward_errors_total")
+            deliveryLog.error("Cannot forward message: %r", e)
+            dedupe.release(account, messages)
+        finally:
+            deliveryQueue.task_done()
+
+# renders and sends one mail for a list of messages (more than one in digest mode),
+# called by the delivery workers
+def processMessages (account, route, messages):
+    renderLog.debug("called for %d messages, route %s", len(messages), route.name)
+    with metrics.timer("render"):
+        rendered = [renderMessage(account, route, *message) for message in messages]
+
+    # envelope, headers and signature are taken from the first message
+    values = rendered[0][0]
+    mailtext = "\n\n".join(route.bodyHeadingTemplate.render(messageValues) + "\n" + text
+                           for messageValues, text, messageAttachments in rendered) \
+        + "\n\n-- \n" + route.mailsignatureTemplate.render(values)
+    attachmentList = [attachment for messageValues, text, messageAttachments in rendered
+                      for attachment in messageAttachments]
+    renderLog.debug("message:\n%s", mailtext)
+
+    subject = route.mailsubjectTemplate.render(values)
+    if len(messages) > 1:
+        subject += " (" + str(len(messages)) + " messages)"
 
     extraHeaders = {}
-    for header, headerValue in headers:
-        headerValue = replacePlaceholders(headerValue, replacements)
+    for header, headerTemplate in route.headerTemplates:
+        headerValue = headerTemplate.render(values)
         if headerValue:
             extraHeaders[header] = headerValue
-    
-    # send mail if activated:
+
+    # send mail if activated, attachments are removed once the mail is accepted:
     if sendmail == True:
-        if debug: print("\nsignalmail is sending emails")
-        sendemail(from_addr    = replacePlaceholders(mailfrom, replacements),
-              addr_list = addr_list,
-              subject      = replacePlaceholders(mailsubject, replacements),
+        deliveryLog.debug("sending mail")
+        entryId = sendemail(account, route,
+              from_addr    = route.mailfromTemplate.render(values),
+              addr_list = route.addr_list,
+              subject      = subject,
               headers      = extraHeaders,
               message      = mailtext,
-              attachmentList   = attachmentList,
-              login        = smtpuser,
-              password     = smtppassword,
-              server       = smtpserver,
-              port         = smtpport )
+              attachmentList   = attachmentList )
+        # the outbox has the mail now, remember its messages across restarts
+        # before the first attempt to send it
+        dedupe.commit(account, messages)
+        outbox.attempt(entryId)
     else:
-        if debug: print("\nsignalmail is not sending emails")
-
-    # deleting attachments if requested:
-    if attachmentList and deleteattachments:
-        if debug: print("DEBUG - main(): removing attachments")
-        for rawAttachment in attachmentList:
-            attachment = get_attachmentFile(rawAttachment)
-            if debug: print("DEBUG - main(): removing attachment " + attachment)
-            os.remove(attachment)
+        deliveryLog.debug("sendmail is off, not sending mail")
+        removeAttachments([get_attachmentFile(rawAttachment) for rawAttachment in attachmentList])
+        dedupe.commit(account, messages)
     return
-#end msgRcvV2
+#end processMessages
+
+# resolves names and mentions of one message, returns the values of the
+# placeholders used by the templates, the message text and its attachments
+def renderMessage (account, route, timestamp, sender, groupId, message, extras):
+    usedPlaceholders = route.usedPlaceholders
+
+    # de- and encode some of the given arguments to more convenient formats
+    mentionList = extras.get("mentions", [])
+    attachmentList = extras.get("attachments", [])
+
+    renderLog.debug("timestamp: %s sender: %s groupId: %s message: %s attachmentList: %s mentionList: %s",
+                    timestamp, sender, groupId, message, attachmentList, mentionList)
+
+    values = {}
+    if "senderId" in usedPlaceholders:
+        values["senderId"] = sender
+    if "groupId" in usedPlaceholders:
+        values["groupId"] = base64.b64encode(bytes(groupId)).decode("utf-8")
+    # a failed lookup (signal-cli gone, JSON-RPC error or timeout) leaves the name
+    # out rather than losing the message
+    if "groupName" in usedPlaceholders:
+        try:
+            values["groupName"] = getGroupName(account, groupId) if groupId else ""
+        except Exception as e:
+            renderLog.error("Cannot look up group name: %r", e)
+            values["groupName"] = ""
+
+    if "senderName" in usedPlaceholders:
+        try:
+            values["senderName"] = getContactName(account, sender)
+        except:
+            values["senderName"] = "unknown"
+        renderLog.debug("sender name: %s", values["senderName"])
+
+    #expand mentions
+    #objectReplacementCharacter is Unicode U+FFFC
+    #  or \xEF\xBF\xBC in UTF-8
+    #objectReplacementCharacter = b'\xEF\xBF\xBC'.decode("utf-8")
+    if mentionList:
+        with metrics.timer("mentions"):
+            lastindex = 0
+            newmessage = ""
+            for mention in mentionList:
+                if isinstance(mention, dict):
+                    number = mention["recipient"]
+                    position = mention["start"]
+                    length = mention["length"]
+                else:
+                    number = mention[0]
+                    position = mention[1]
+                    length = mention[2]
+                messagepart = message[lastindex:position]
+                try:
+                    name = getContactName(account, number)
+                except Exception as e:
+                    renderLog.error("Cannot look up name of mentioned %s: %r", number, e)
+                    name = ""
+                newmessage += messagepart + "@" + number
+                if name:
+                    newmessage += " (" + name + ")"
+                lastindex = position + length
+                renderLog.debug("building message: %s", newmessage)
+            if (lastindex <= len(message)):
+                newmessage += message[lastindex:]
+            message = newmessage
+            renderLog.debug("final message is: %s", message)
+
+    if "timestamp" in usedPlaceholders:
+        # timestamp includes milliseconds, we have to strip them:
+        timestamp = datetime.datetime.fromtimestamp(float(str(timestamp)[0:-3]), getLocalTimezone())
+        values["timestamp"] = timestamp.strftime(account.settings.timeformat)
+
+    renderLog.debug("placeholder values %s", values)
+    return values, message, attachmentList
+#end renderMessage
 
 def rcptRcv (timestamp, sender):
     global APIV2
     if APIV2: return
-    if debug:
-        print ("rcptRcv called")
-        print (sender)
+    intakeLog.debug("rcptRcv called for %s", sender)
     return
 
 #
@@ -395,111 +1588,1330 @@ def rcptRcv (timestamp, sender):
 # - unknown
 #
 def rcptRcvV2 (timestamp, sender, type, extras):
-    global APIV2
-    APIV2 = True
-    if debug:
-        print ("rcptRcvV2 called")
-        print("timestamp: ", timestamp, ", sender: ", sender, ", type: ", type, ", extras: ", extras)
+    if not APIV2: useAPIV2()
+    intakeLog.debug("rcptRcvV2 called, timestamp: %s, sender: %s, type: %s, extras: %s", timestamp, sender, type, extras)
     return
 
 def syncRcv (timestamp, sender, destination, groupId, message, attachmentList):
     global APIV2
     if APIV2: return
-    if debug:
-        print ("syncRcv called")
-        print (sender)
+    intakeLog.debug("syncRcv called for %s", sender)
     return
 
 def syncRcvV2 (timestamp, sender, destination, groupId, message, extras):
-    global APIV2
-    APIV2 = True
-    if debug:
-        print ("syncRcvV2 called")
-        print (sender)
+    if not APIV2: useAPIV2()
+    intakeLog.debug("syncRcvV2 called for %s", sender)
     return
 
-# function handles sending of emails
-def sendemail(from_addr, addr_list, subject, headers, message, attachmentList, login, password, server, port):
-    if debug: print("DEBUG - sendemail(): called, login=" + login + " password=" + password + " server=" + server + " port=" + port + "\nMessage=", message)
-    if debug: print("DEBUG - sendemail(): attachmentList=")
-    if debug: print(attachmentList)
-    msg = EmailMessage()
-    msg["From"] = from_addr
-    msg["To"] = addr_list
-    msg["Subject"] = subject
-    # add sender and group as custom headers
-    for header, headerValue in headers.items():
-        msg[header] = headerValue
-    msg.set_content(message)
-
+# deleting attachments if requested:
+def removeAttachments(attachments):
+    if attachments and deleteattachments:
+        attachmentLog.debug("removing attachments")
+        for attachment in attachments:
+            attachmentLog.debug("removing attachment %s", attachment)
+            try:
+                os.remove(attachment)
+            except FileNotFoundError:
+                attachmentLog.debug("%s is already gone", attachment)
+
+# limits the bytes of oversize attachments worked on at the same time,
+# a single attachment larger than the budget still gets through on its own
+class ByteBudget:
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        size = min(size, self.limit)
+        with self.condition:
+            while self.used and self.used + size > self.limit:
+                self.condition.wait()
+            self.used += size
+        return size
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+#end class ByteBudget
+
+attachmentBudget = ByteBudget(max(attachment_budget, 1) * 1024 * 1024)
+
+# oversize attachments are handled in worker processes, so recompressing and hashing
+# neither holds up the main loop nor competes with the delivery workers for the GIL;
+# "spawn" because forking a process with running threads is not safe
+attachmentPool = None
+attachmentPoolLock = threading.Lock()
+def getAttachmentPool():
+    global attachmentPool
+    with attachmentPoolLock:
+        if attachmentPool is None:
+            attachmentPool = futures.ProcessPoolExecutor(max_workers=max(attachment_workers, 1),
+                                                         mp_context=multiprocessing.get_context("spawn"))
+            attachmentLog.debug("started %d attachment processes", max(attachment_workers, 1))
+        return attachmentPool
+
+def shutdownAttachmentPool():
+    with attachmentPoolLock:
+        if attachmentPool is not None:
+            attachmentPool.shutdown()
+
+# returns the parts (file, content type, file name) of the mail, notes for the mail body
+# about stored or dropped attachments, and recompressed files to remove once the mail is spooled
+def prepareAttachments(attachmentList):
+    parts = []
+    notes = []
+    temporaryFiles = []
+    limit = float(max_attachmentsize) * 1024 * 1024
     for rawAttachment in attachmentList:
         attachment = get_attachmentFile(rawAttachment)
-        # check for size limit before proceeding:
-        attachmentsize =  get_attachmentFileSize(rawAttachment) / 1024.0 / 1024.0
-        if debug: print("DEBUG - sendemail(): attachmentsize=",attachmentsize,"MB")
-        if attachmentsize <= float(max_attachmentsize):
-            ctype, raw_data = get_attachmentContentType(rawAttachment)
-            if debug: print("DEBUG - sendemail(): ctype=",ctype)
-            maintype, subtype = ctype.split("/", 1)
-            ext = mimetypes.guess_extension(ctype, strict=False)
-            filename = get_attachmentRemoteName(rawAttachment)
-            if filename == "":
-                filename = os.path.basename(attachment) + ext
-            msg.add_attachment(raw_data, maintype=maintype, subtype=subtype, filename=filename)
+        attachmentsize = get_attachmentFileSize(rawAttachment)
+        ctype = get_attachmentContentType(rawAttachment)
+        attachmentLog.debug("attachmentsize=%d ctype=%s", attachmentsize, ctype)
+        ext = guessExtension(ctype)
+        filename = get_attachmentRemoteName(rawAttachment)
+        if filename == "":
+            filename = os.path.basename(attachment) + ext
+        if attachmentsize <= limit:
+            parts.append((attachment, ctype, filename))
+            continue
+        attachmentLog.debug("attachment size of %d bytes bigger than maximum size of %s MB", attachmentsize, max_attachmentsize)
+        try:
+            result = processOversizeAttachment(attachment, ctype, filename, attachmentsize, limit)
+        except Exception as e:
+            attachmentLog.error("Cannot process attachment %s: %r", attachment, e)
+            result = None
+        if result is None:
+            metrics.count("signalmail_attachments_dropped_total")
+            notes.append("[attachment " + filename + " (" + formatSize(attachmentsize) + ") left out, it is larger than " + str(max_attachmentsize) + " MB]")
+        elif result[0] == "recompressed":
+            metrics.count("signalmail_attachments_recompressed_total")
+            parts.append((result[1], "image/jpeg", os.path.splitext(filename)[0] + ".jpg"))
+            temporaryFiles.append(result[1])
+        else:
+            metrics.count("signalmail_attachments_stored_total")
+            if attachment_store_url:
+                reference = attachment_store_url.rstrip("/") + "/" + os.path.relpath(result[1], attachment_store).replace(os.sep, "/")
+            else:
+                reference = result[1]
+            notes.append("[attachment " + filename + " (" + formatSize(attachmentsize) + ") stored as " + reference + "]")
+    return parts, notes, temporaryFiles
+
+def formatSize(size):
+    return "%.1f MB" % (size / 1024.0 / 1024.0)
+
+# hands one attachment to the worker processes within the byte budget,
+# returns ("recompressed", temporary file), ("stored", path in the store) or None
+def processOversizeAttachment(attachment, ctype, filename, attachmentsize, limit):
+    recompress = recompress_images and ctype.startswith("image/") and ctype != "image/gif"
+    if not recompress and oversize_attachments == "drop":
+        return None
+    reserved = attachmentBudget.acquire(int(attachmentsize))
+    try:
+        future = getAttachmentPool().submit(shrinkAttachment, attachment, os.path.splitext(filename)[1] or guessExtension(ctype),
+                                            int(limit), recompress, oversize_attachments == "store",
+                                            attachment_store, image_maxsize, image_quality, stream_buffersize)
+        result = future.result()
+    finally:
+        attachmentBudget.release(reserved)
+    attachmentLog.debug("%s -> %s", attachment, result)
+    return result
+
+# runs in a worker process: recompresses an image below limit bytes or copies the
+# file into the content-addressed store, named by its SHA-256 hash and ext
+def shrinkAttachment(attachment, ext, limit, recompress, store, storeDirectory, maxsize, quality, buffersize):
+    temporaryDirectory = os.path.join(storeDirectory, "tmp")
+    os.makedirs(temporaryDirectory, exist_ok=True)
+    if recompress:
+        temporaryFile = os.path.join(temporaryDirectory, uuid.uuid4().hex + ".jpg")
+        if recompressImage(attachment, temporaryFile, limit, maxsize, quality):
+            return ("recompressed", temporaryFile)
+        try:
+            os.remove(temporaryFile)
+        except FileNotFoundError: True
+    if not store:
+        return None
+    digest = hashlib.sha256()
+    temporaryFile = os.path.join(temporaryDirectory, uuid.uuid4().hex)
+    with open(attachment, "rb") as source, open(temporaryFile, "wb") as target:
+        while True:
+            chunk = source.read(buffersize)
+            if not chunk:
+                break
+            digest.update(chunk)
+            target.write(chunk)
+    name = digest.hexdigest()
+    stored = os.path.join(storeDirectory, name[:2], name + ext)
+    if os.path.exists(stored):
+        # the same content was stored before
+        os.remove(temporaryFile)
+    else:
+        os.makedirs(os.path.dirname(stored), exist_ok=True)
+        os.replace(temporaryFile, stored)
+    return ("stored", stored)
+
+# scales the image down to maxsize pixels and saves it as JPEG, lowering size and quality
+# until it fits into limit bytes; False if Pillow is missing or the image cannot be read
+def recompressImage(source, target, limit, maxsize, quality):
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return False
+    try:
+        with Image.open(source) as image:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((maxsize, maxsize))
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+            for attempt in range(6):
+                image.save(target, "JPEG", quality=quality, optimize=True)
+                if os.path.getsize(target) <= limit:
+                    return True
+                quality = max(quality - 10, 40)
+                image = image.resize((max(image.width * 3 // 4, 1), max(image.height * 3 // 4, 1)))
+    except (OSError, ValueError):
+        return False
+    return False
+
+# function handles sending of emails: the rendered mail is spooled to the outbox and its
+# entry id returned, the caller sends it with outbox.attempt()
+def sendemail(account, route, from_addr, addr_list, subject, headers, message, attachmentList):
+    deliveryLog.debug("called, server=%s port=%s attachmentList=%s\nMessage=%s", route.smtp.server, route.smtp.port, attachmentList, message)
+    # attachments are not read here, their content is streamed into the outbox by writeMessage()
+    with metrics.timer("attachments"):
+        parts, notes, temporaryFiles = prepareAttachments(attachmentList)
+    if notes:
+        # references to stored attachments go above the signature
+        body, separator, signature = message.rpartition("\n-- \n")
+        if separator:
+            message = body.rstrip("\n") + "\n\n" + "\n".join(notes) + "\n" + separator + signature
+        else:
+            message += "\n\n" + "\n".join(notes)
+
+    with metrics.timer("mime"):
+        msg = emailMessage.EmailMessage()
+        msg["From"] = from_addr
+        msg["To"] = addr_list
+        msg["Subject"] = subject
+        # add sender and group as custom headers
+        for header, headerValue in headers.items():
+            msg[header] = headerValue
+        msg.set_content(message)
+
+    # record the mail on disk before talking to the SMTP server, so it survives failures and restarts:
+    attachments = [get_attachmentFile(rawAttachment) for rawAttachment in attachmentList]
+    try:
+        with metrics.timer("spool"):
+            entryId = outbox.add(account, from_addr, account.settings.splitRecipients(route.smtp, addr_list.split(',')), attachments, lambda fp: writeMessage(fp, msg, parts))
+    finally:
+        # recompressed images are part of the spooled mail now
+        for temporaryFile in temporaryFiles:
+            try:
+                os.remove(temporaryFile)
+            except FileNotFoundError: True
+    deliveryLog.debug("spooled as %s", entryId)
+    return entryId
+#end sendemail(account, route, from_addr, addr_list, subject, headers, message, attachmentList):
+
+# writes msg with CRLF line endings to fp, followed by the attachment parts
+# (file, content type, file name), which are base64 encoded chunk by chunk
+def writeMessage(fp, msg, parts):
+    if not parts:
+        fp.write(msg.as_string(policy=emailPolicy.SMTP).encode("utf-8"))
+        return
+    boundary = "===============signalmail_" + uuid.uuid4().hex
+    msg.make_mixed()
+    msg.set_boundary(boundary)
+    closing = "--" + boundary + "--\r\n"
+    head = msg.as_string(policy=emailPolicy.SMTP)
+    # the generator ends with the closing delimiter, the attachments have to go before it
+    fp.write(head[:-len(closing)].encode("utf-8"))
+    # a multiple of 57 bytes gives full 76 character base64 lines
+    chunksize = max(stream_buffersize // 57, 1) * 57
+    for attachment, ctype, filename in parts:
+        part = emailMessage.EmailMessage()
+        part["Content-Type"] = ctype
+        part["Content-Transfer-Encoding"] = "base64"
+        part.add_header("Content-Disposition", "attachment", filename=filename)
+        fp.write(b"--" + boundary.encode("ascii") + b"\r\n")
+        fp.write(part.as_string(policy=emailPolicy.SMTP).encode("utf-8"))
+        with open(attachment, "rb") as attachmentfp:
+            while True:
+                chunk = attachmentfp.read(chunksize)
+                if not chunk:
+                    break
+                fp.write(base64.encodebytes(chunk).replace(b"\n", b"\r\n"))
+        fp.write(b"\r\n")
+    fp.write(closing.encode("ascii"))
+
+# crash-safe spool of rendered mails in data_dir/outbox/, one file per mail.
+# Each file holds a line of JSON (account, sender, the recipients of each relay and attachments
+# to remove) followed by the message itself. It is written to a .tmp file and renamed, so a
+# file with the .msg suffix is always complete. Recipients that are done are appended to a
+# .done file next to it, so a retry only goes to the rest; both are removed once all
+# recipients accepted the mail, or moved to failed/ if some rejected it.
+class Outbox:
+    def __init__(self, directory):
+        self.directory = directory
+        self.failedDirectory = os.path.join(directory, "failed", "")
+        self.pending = {} # entry id -> (failed attempts, monotonic time of next attempt)
+        self.condition = threading.Condition()
+        self.counter = itertools.count()
+        self.fanout = None
+        self.fanoutLock = threading.Lock()
+
+    def path(self, entryId):
+        return os.path.join(self.directory, entryId + ".msg")
+
+    def donePath(self, entryId):
+        return os.path.join(self.directory, entryId + ".done")
+
+    # pick up mails left over from the last run, they are retried right away
+    def load(self):
+        os.makedirs(self.failedDirectory, exist_ok=True)
+        filenames = os.listdir(self.directory)
+        for filename in sorted(filenames):
+            if filename.endswith(".tmp"):
+                # never completely written, the message was not acknowledged anywhere
+                os.remove(os.path.join(self.directory, filename))
+            elif filename.endswith(".done") and filename[:-5] + ".msg" not in filenames:
+                os.remove(os.path.join(self.directory, filename))
+            elif filename.endswith(".msg"):
+                with self.condition:
+                    self.pending[filename[:-4]] = (0, 0)
+        deliveryLog.debug("%d mails pending in %s", len(self.pending), self.directory)
+
+    def start(self):
+        retrier = threading.Thread(target=self.run, name="outbox", daemon=True)
+        retrier.start()
+
+    # deliveries is a list of {"smtp": profile name, "to": addresses},
+    # write(fp) writes the message after the envelope line
+    def add(self, account, from_addr, deliveries, attachments, write):
+        entryId = "%020d-%06d" % (time.time_ns(), next(self.counter))
+        path = self.path(entryId)
+        envelope = {"account": account.signalnumber, "from": from_addr, "deliveries": deliveries, "attachments": attachments}
+        with open(path + ".tmp", "wb") as fp:
+            fp.write(json.dumps(envelope).encode("utf-8") + b"\n")
+            write(fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(path + ".tmp", path)
+        deliveryLog.debug("spooled %s", path)
+        return entryId
+
+    # recipient -> status ("sent" or the rejection) of the recipients that are done
+    def readDone(self, entryId):
+        done = {}
+        try:
+            with open(self.donePath(entryId), "r", encoding="utf-8") as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue # cut off by a crash
+                    done[record["to"]] = record["status"]
+        except FileNotFoundError: True
+        return done
+
+    def writeDone(self, entryId, statuses):
+        with open(self.donePath(entryId), "a", encoding="utf-8") as fp:
+            for to_addr, status in statuses.items():
+                fp.write(json.dumps({"to": to_addr, "status": status}) + "\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def getFanout(self):
+        with self.fanoutLock:
+            if self.fanout is None:
+                self.fanout = futures.ThreadPoolExecutor(max_workers=max(fanout_connections, 1), thread_name_prefix="fanout")
+            return self.fanout
+
+    # sends the mail to all recipients not done yet, one transaction per relay and batch of
+    # recipients, in parallel if there is more than one; returns True once all accepted it
+    def deliver(self, entryId):
+        with open(self.path(entryId), "rb") as fp:
+            envelope = json.loads(fp.readline())
+            offset = fp.tell()
+        # spooled mails are sent with the relays configured now
+        current = settings
+        account = current.accountsByNumber.get(envelope.get("account"), current.accounts[0])
+        # mails spooled before there were several relays per mail
+        deliveries = envelope.get("deliveries") or [{"smtp": envelope.get("smtp"), "to": envelope.get("to", [])}]
+        done = self.readDone(entryId)
+        transactions = []
+        for delivery in deliveries:
+            # sent through the SMTP profile, or the relay of the account if it is gone from the config,
+            # falling back to the first account if that is gone too
+            smtp = current.smtpProfiles.get(delivery["smtp"]) or account.smtp
+            to_addrs = [to_addr for to_addr in delivery["to"] if to_addr not in done]
+            batch = max(fanout_batch, 1)
+            for start in range(0, len(to_addrs), batch):
+                transactions.append((smtp, to_addrs[start:start + batch]))
+        if len(transactions) == 1:
+            results = [self.transmit(entryId, offset, envelope["from"], *transactions[0])]
         else:
-            if debug: print("DEBUG - messagehandler(): Attachment size of ", attachmentsize, " bigger than maximum size of ", max_attachmentsize, "MB, skipping!", sep='')
-
-    # send the email to SMTP server:
-    server = smtplib.SMTP(server, port, timeout=10)
-    if debug: server.set_debuglevel(1)
-    server.starttls()
-    server.login(login,password)
-    server.sendmail(from_addr, addr_list.split(','), msg.as_string())
-    server.quit()
-    if debug: print("DEBUG - sendemail(): finished")
-#end sendemail(from_addr, addr_list, subject, message, attachmentList, login, password, server, port):
-
-# Replace multiple placeholders according to the keys of repalcements dict
-def replacePlaceholders(inputString, replacements):
-    if debug: print("DEBUG - replacements", replacements)
-    return reduce(lambda a, kv: a.replace(*kv), replacements.items(), inputString)
+            fanout = self.getFanout()
+            results = [future.result() for future in
+                       [fanout.submit(self.transmit, entryId, offset, envelope["from"], smtp, to_addrs) for smtp, to_addrs in transactions]]
+
+        statuses = {}
+        retries = []
+        for result, retry in results:
+            statuses.update(result)
+            if retry is not None:
+                retries.append(retry)
+        if statuses:
+            self.writeDone(entryId, statuses)
+            done.update(statuses)
+            metrics.count("signalmail_recipients_sent_total", sum(1 for status in statuses.values() if status == "sent"))
+        if retries:
+            errors = [error for kind, error in retries if kind == "retry"]
+            if errors:
+                self.reschedule(entryId, errors[0])
+            else:
+                self.defer(entryId, min(delay for kind, delay in retries))
+            return False
+
+        rejected = {to_addr: status for to_addr, status in done.items() if status != "sent"}
+        if rejected:
+            # permanent error, retrying will not help
+            deliveryLog.error("Mail %s rejected for %s, moving it to %s", entryId, ", ".join(rejected), self.failedDirectory)
+            for to_addr, status in rejected.items():
+                deliveryLog.error("%s: %s", to_addr, status)
+            self.fail(entryId)
+            return False
+        os.remove(self.path(entryId))
+        try:
+            os.remove(self.donePath(entryId))
+        except FileNotFoundError: True
+        metrics.count("signalmail_mails_sent_total")
+        removeAttachments(envelope["attachments"])
+        self.drain(entryId)
+        deliveryLog.debug("delivered %s", entryId)
+        return True
+
+    # delivers the entry like deliver(), but never raises: an entry that cannot be read
+    # is given up, a mail that fails in any other unforeseen way goes to failed/
+    def attempt(self, entryId):
+        try:
+            return self.deliver(entryId)
+        except OSError as e:
+            deliveryLog.error("Cannot read outbox entry %s: %r", entryId, e)
+            with self.condition:
+                self.pending.pop(entryId, None)
+        except Exception as e:
+            deliveryLog.error("Cannot send mail %s, moving it to %s: %r", entryId, self.failedDirectory, e)
+            try:
+                self.fail(entryId)
+            except OSError as e:
+                deliveryLog.error("Cannot move outbox entry %s: %r", entryId, e)
+                with self.condition:
+                    self.pending.pop(entryId, None)
+        return False
+
+    def fail(self, entryId):
+        try:
+            os.replace(self.donePath(entryId), os.path.join(self.failedDirectory, entryId + ".done"))
+        except FileNotFoundError: True
+        os.replace(self.path(entryId), os.path.join(self.failedDirectory, entryId + ".msg"))
+        metrics.count("signalmail_mails_rejected_total")
+        with self.condition:
+            self.pending.pop(entryId, None)
+
+    # one SMTP transaction for some of the recipients, reading the message from its own file handle;
+    # returns the status of the recipients that are done, and ("defer", seconds) or ("retry", error)
+    # if the others have to wait
+    def transmit(self, entryId, offset, from_addr, smtp, to_addrs):
+        delay = rateLimiter.acquire(smtp, to_addrs)
+        while delay > 0 and queue_policy == "block":
+            time.sleep(delay)
+            delay = rateLimiter.acquire(smtp, to_addrs)
+        if delay > 0:
+            metrics.count("signalmail_rate_limited_total")
+            deliveryLog.debug("quota of %s used up, %s waits %.1f seconds", smtp.server, entryId, delay)
+            return {}, ("defer", delay)
+        try:
+            with open(self.path(entryId), "rb") as fp:
+                fp.seek(offset)
+                with metrics.timer("smtp"):
+                    refused = getSMTPSession(smtp).sendfile(from_addr, to_addrs, fp)
+        except smtplib.SMTPRecipientsRefused as e:
+            refused = e.recipients
+        except (smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+            rateLimiter.release(smtp, to_addrs, True)
+            # replies to this mail: a permanent one rejects it
+            if e.smtp_code in throttlingCodes:
+                return {}, ("defer", self.throttle(entryId, smtp, e))
+            if e.smtp_code >= 500:
+                return {to_addr: replyText(e.smtp_code, e.smtp_error) for to_addr in to_addrs}, None
+            return {}, ("retry", e)
+        except (smtplib.SMTPException, OSError) as e:
+            rateLimiter.release(smtp, to_addrs, True)
+            if isinstance(e, smtplib.SMTPResponseException) and e.smtp_code in throttlingCodes:
+                return {}, ("defer", self.throttle(entryId, smtp, e))
+            # the relay is unreachable or refuses the session (greeting, EHLO, STARTTLS,
+            # AUTH), which no mail can fix; hold back the other mails to it as well
+            rateLimiter.throttle(smtp)
+            return {}, ("retry", e)
+
+        statuses = {}
+        temporary = {}
+        for to_addr in to_addrs:
+            if to_addr not in refused:
+                statuses[to_addr] = "sent"
+            elif refused[to_addr][0] >= 500:
+                statuses[to_addr] = replyText(*refused[to_addr])
+            else:
+                temporary[to_addr] = refused[to_addr]
+        notSent = [to_addr for to_addr in to_addrs if to_addr in refused]
+        if notSent:
+            rateLimiter.release(smtp, notSent, len(notSent) == len(to_addrs))
+        if len(temporary) < len(to_addrs):
+            rateLimiter.accepted(smtp)
+        if not temporary:
+            return statuses, None
+        error = smtplib.SMTPRecipientsRefused(temporary)
+        if all(code in throttlingCodes for code, response in temporary.values()):
+            return statuses, ("defer", self.throttle(entryId, smtp, error))
+        return statuses, ("retry", error)
+
+    # the relay wants us to slow down: pause everything going there
+    def throttle(self, entryId, smtp, error):
+        delay = rateLimiter.throttle(smtp)
+        metrics.count("signalmail_smtp_throttled_total")
+        deliveryLog.warning("Mail server %s is throttling, sending %s in %ss: %r", smtp.server, entryId, delay, error)
+        return delay
+
+    def reschedule(self, entryId, error):
+        with self.condition:
+            attempts = self.pending.get(entryId, (0, 0))[0] + 1
+            delay = min(retry_initial * 2 ** (attempts - 1), retry_max)
+            self.pending[entryId] = (attempts, time.monotonic() + delay)
+            self.condition.notify()
+        metrics.count("signalmail_delivery_retries_total")
+        deliveryLog.warning("Cannot send mail %s, retrying in %ss: %r", entryId, delay, error)
+
+    # wait for quota without counting a failed attempt
+    def defer(self, entryId, delay):
+        with self.condition:
+            attempts = self.pending.get(entryId, (0, 0))[0]
+            self.pending[entryId] = (attempts, time.monotonic() + delay)
+            self.condition.notify()
+
+    # the server accepted a mail, so everything still waiting is retried immediately
+    def drain(self, entryId):
+        with self.condition:
+            self.pending.pop(entryId, None)
+            if self.pending:
+                for pendingId, (attempts, nextAttempt) in self.pending.items():
+                    if nextAttempt != float("inf"):
+                        self.pending[pendingId] = (attempts, 0)
+                self.condition.notify()
+
+    # retry thread: sends due mails oldest first and sleeps until the next one is due
+    def run(self):
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                due = sorted(entryId for entryId, (attempts, nextAttempt) in self.pending.items() if nextAttempt <= now)
+                if not due:
+                    timeout = min((nextAttempt for attempts, nextAttempt in self.pending.values()), default=None)
+                    self.condition.wait(None if timeout is None else timeout - now)
+                    continue
+                # claim the due mails so a concurrent drain does not hand them out twice
+                for entryId in due:
+                    self.pending[entryId] = (self.pending[entryId][0], float("inf"))
+            for entryId in due:
+                self.attempt(entryId)
+#end class Outbox
+
+outbox = Outbox(os.path.join(data_dir, "outbox", ""))
+
+# 421, 451 and 452 are how relays say "too much, try later"
+throttlingCodes = (421, 451, 452)
+
+def replyText(code, response):
+    if isinstance(response, bytes):
+        response = response.decode("utf-8", "replace")
+    return str(code) + " " + response
+
+# holds up to capacity tokens, refilled evenly over period seconds
+class TokenBucket:
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    # seconds until count tokens are there, 0 if they are
+    def delay(self, count, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        count = min(count, self.capacity)
+        if self.tokens >= count:
+            return 0
+        return (count - self.tokens) / self.rate
+
+    def take(self, count):
+        self.tokens -= min(count, self.capacity)
+
+    def give(self, count):
+        self.tokens = min(self.capacity, self.tokens + min(count, self.capacity))
+#end class TokenBucket
+
+# quotas per relay (server, port and login) and per recipient, and the pause
+# after the relay answered with one of the throttlingCodes
+class RateLimiter:
+    def __init__(self):
+        self.buckets = {}
+        self.pausedUntil = {} # relay -> monotonic time
+        self.throttled = {} # relay -> throttling replies in a row
+        self.lock = threading.Lock()
+
+    def bucket(self, key, capacity, period):
+        bucket = self.buckets.get(key)
+        # a reload may have changed the quota
+        if bucket is None or bucket.capacity != capacity:
+            bucket = self.buckets[key] = TokenBucket(capacity, period)
+        return bucket
+
+    # takes the tokens for one mail and returns 0, or returns the seconds to wait without taking any
+    def acquire(self, smtp, to_addrs):
+        relay = (smtp.server, str(smtp.port), smtp.user)
+        with self.lock:
+            now = time.monotonic()
+            needed = []
+            if smtp.messagesPerMinute > 0:
+                needed.append((self.bucket(("messages",) + relay, smtp.messagesPerMinute, 60), 1))
+            if smtp.recipientsPerHour > 0:
+                needed.append((self.bucket(("recipients",) + relay, smtp.recipientsPerHour, 3600), len(to_addrs)))
+            if smtp.mailsPerRecipientPerHour > 0:
+                for to_addr in to_addrs:
+                    needed.append((self.bucket(("recipient", to_addr.strip().lower()) + relay, smtp.mailsPerRecipientPerHour, 3600), 1))
+            delay = max([self.pausedUntil.get(relay, 0) - now] + [bucket.delay(count, now) for bucket, count in needed])
+            if delay > 0:
+                return delay
+            for bucket, count in needed:
+                bucket.take(count)
+            return 0
+
+    # gives back what acquire() took for recipients the relay did not accept, and for the
+    # mail if it took none of them, so throttled or failed attempts do not use up the quota
+    def release(self, smtp, to_addrs, message):
+        relay = (smtp.server, str(smtp.port), smtp.user)
+        with self.lock:
+            if message and smtp.messagesPerMinute > 0:
+                self.bucket(("messages",) + relay, smtp.messagesPerMinute, 60).give(1)
+            if smtp.recipientsPerHour > 0:
+                self.bucket(("recipients",) + relay, smtp.recipientsPerHour, 3600).give(len(to_addrs))
+            if smtp.mailsPerRecipientPerHour > 0:
+                for to_addr in to_addrs:
+                    self.bucket(("recipient", to_addr.strip().lower()) + relay, smtp.mailsPerRecipientPerHour, 3600).give(1)
+
+    # pauses the relay for retry_initial seconds, doubling with every throttling reply
+    # or failed connection in a row
+    def throttle(self, smtp):
+        relay = (smtp.server, str(smtp.port), smtp.user)
+        with self.lock:
+            self.throttled[relay] = self.throttled.get(relay, 0) + 1
+            delay = min(retry_initial * 2 ** (self.throttled[relay] - 1), retry_max)
+            self.pausedUntil[relay] = time.monotonic() + delay
+        return delay
+
+    def accepted(self, smtp):
+        with self.lock:
+            self.throttled.pop((smtp.server, str(smtp.port), smtp.user), None)
+#end class RateLimiter
+
+rateLimiter = RateLimiter()
+
+# long-lived, authenticated connection to one SMTP server
+# replaces smtplib's printing of the protocol trace
+def logSMTPTrace(*args):
+    # one template for all of the trace, so sampling applies to it as a whole
+    smtpLog.debug("%s", " ".join(str(arg) for arg in args))
+
+class SMTPSession:
+    def __init__(self, smtp, idletimeout):
+        self.server = smtp.server
+        self.port = smtp.port
+        # the profile of the settings in force, replaced by getSMTPSession() after
+        # a reload, so new connections use the current password and STARTTLS setting
+        self.smtp = smtp
+        self.idletimeout = idletimeout
+        self.connection = None
+        self.idleUntil = 0 # monotonic time after which the open connection is closed
+        self.lock = threading.RLock()
+
+    def connect(self):
+        smtpLog.debug("connecting to %s:%s", self.server, self.port)
+        connection = smtplib.SMTP(self.server, self.port, timeout=10)
+        if smtpLog.level == logging.DEBUG:
+            # smtplib's protocol trace, only with smtp = DEBUG in [LOGGING] as it holds
+            # every mail; it goes through the log, where credentials are redacted
+            connection._print_debug = logSMTPTrace
+            connection.set_debuglevel(1)
+        try:
+            smtp = self.smtp
+            if smtp.starttls:
+                connection.starttls()
+            if smtp.user:
+                connection.login(smtp.user, smtp.password)
+        except:
+            connection.close()
+            raise
+        return connection
+
+    # returns an open connection, checking a reused one with NOOP first
+    def get(self):
+        if self.connection is not None and time.monotonic() > self.idleUntil:
+            # idle for too long, the reaper has not got to it yet
+            self.close()
+        if self.connection is not None:
+            try:
+                code, response = self.connection.noop()
+                if code != 250:
+                    raise smtplib.SMTPServerDisconnected("NOOP returned " + str(code))
+                smtpLog.debug("reusing connection to %s", self.server)
+            except (smtplib.SMTPException, OSError) as e:
+                smtpLog.debug("connection to %s lost (%s), reconnecting", self.server, e)
+                self.close()
+        if self.connection is None:
+            self.connection = self.connect()
+        return self.connection
+
+    # sends the message read from fp, which has to use CRLF line endings
+    def sendfile(self, from_addr, to_addrs, fp):
+        start = fp.tell()
+        with self.lock:
+            try:
+                try:
+                    refused = sendStream(self.get(), from_addr, to_addrs, fp)
+                except smtplib.SMTPServerDisconnected:
+                    # server dropped us between NOOP and the transaction, try once more
+                    self.close()
+                    fp.seek(start)
+                    refused = sendStream(self.get(), from_addr, to_addrs, fp)
+            except (smtplib.SMTPServerDisconnected, smtplib.SMTPDataError, OSError, ValueError):
+                # the connection may be stuck in the middle of DATA, or of the
+                # transaction if an address could not be encoded
+                self.close()
+                raise
+            if self.idletimeout > 0:
+                self.idleUntil = time.monotonic() + self.idletimeout
+            else:
+                self.close()
+        return refused
+
+    # called by the reaper thread, leaves a session that is sending alone
+    def closeIfIdle(self, now):
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            if self.connection is not None and now > self.idleUntil:
+                self.close()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        with self.lock:
+            if self.connection is None:
+                return
+            smtpLog.debug("closing connection to %s", self.server)
+            try:
+                self.connection.quit()
+            except (smtplib.SMTPException, OSError):
+                self.connection.close()
+            self.connection = None
+#end class SMTPSession
+
+# SMTP transaction like smtplib.SMTP.sendmail(), but the message is copied from fp to
+# the DATA stream in blocks of stream_buffersize instead of being held in memory
+def sendStream(connection, from_addr, to_addrs, fp):
+    connection.ehlo_or_helo_if_needed()
+    code, response = connection.mail(from_addr)
+    if code != 250:
+        connection.rset()
+        raise smtplib.SMTPSenderRefused(code, response, from_addr)
+    refused = {}
+    for to_addr in to_addrs:
+        code, response = connection.rcpt(to_addr)
+        if code not in (250, 251):
+            refused[to_addr] = (code, response)
+    if len(refused) == len(to_addrs):
+        connection.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    connection.putcmd("data")
+    code, response = connection.getreply()
+    if code != 354:
+        raise smtplib.SMTPDataError(code, response)
+    buffer = bytearray()
+    line = b"\r\n"
+    for line in fp:
+        # dot-stuffing, see RFC 5321 section 4.5.2
+        if line.startswith(b"."):
+            buffer += b"."
+        buffer += line
+        if len(buffer) >= stream_buffersize:
+            connection.send(bytes(buffer))
+            buffer.clear()
+    if not line.endswith(b"\r\n"):
+        buffer += b"\r\n"
+    buffer += b".\r\n"
+    connection.send(bytes(buffer))
+    code, response = connection.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, response)
+    return refused
+
+# one session per delivery worker and server/port/login, created on first use
+smtpSessions = {}
+smtpSessionsLock = threading.Lock()
+def getSMTPSession(smtp):
+    key = (threading.current_thread().name, smtp.server, str(smtp.port), smtp.user)
+    with smtpSessionsLock:
+        session = smtpSessions.get(key)
+        if session is None:
+            session = SMTPSession(smtp, smtp_idletimeout)
+            smtpSessions[key] = session
+            startSMTPReaper()
+        elif session.smtp is not smtp:
+            if (session.smtp.password, session.smtp.starttls) != (smtp.password, smtp.starttls):
+                # a reload changed how to log in, the open connection used the old way
+                session.close()
+            session.smtp = smtp
+    return session
+
+# one thread closes the connections idle for smtp_idletimeout, for all sessions
+smtpReaper = None
+
+def startSMTPReaper():
+    global smtpReaper
+    if smtpReaper is None and smtp_idletimeout > 0:
+        smtpReaper = threading.Thread(target=reapSMTPSessions, name="smtp-reaper", daemon=True)
+        smtpReaper.start()
+
+def reapSMTPSessions():
+    while True:
+        time.sleep(max(smtp_idletimeout / 2.0, 1))
+        with smtpSessionsLock:
+            sessions = list(smtpSessions.values())
+        now = time.monotonic()
+        for session in sessions:
+            session.closeIfIdle(now)
+
+def closeSMTPSessions():
+    with smtpSessionsLock:
+        sessions = list(smtpSessions.values())
+    for session in sessions:
+        session.close()
 
 # Why is Python so great?
 def getLocalTimezone():
     return datetime.datetime.now(datetime.timezone.utc).astimezone().tzinfo
 
-def connectToDBus():
+# time limited LRU cache for names, keys are "contact:<account>:<number>" or "group:<account>:<base64 id>"
+class NameCache:
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict() # key -> (name, expiry timestamp)
+        self.lock = threading.Lock()
+
+    # returns the cached name, calling lookup() on a miss or after expiry
+    def get(self, key, lookup):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > time.time():
+                self.entries.move_to_end(key)
+                metrics.count("signalmail_name_cache_hits_total")
+                return entry[0]
+        metrics.count("signalmail_name_cache_misses_total")
+        with metrics.timer("dbus_lookup"):
+            name = lookup()
+        self.put(key, name)
+        return name
+
+    def put(self, key, name, expiry=None):
+        if expiry is None:
+            expiry = time.time() + self.ttl
+        with self.lock:
+            self.entries[key] = (name, expiry)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def load(self, path):
+        try:
+            with open(path, "r", encoding="utf-8") as fp:
+                entries = json.load(fp)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            signalLog.error("Cannot read name cache %s: %r", path, e)
+            return
+        now = time.time()
+        for key, (name, expiry) in entries.items():
+            if expiry > now:
+                self.put(key, name, expiry)
+        signalLog.debug("loaded %d names from %s", len(self.entries), path)
+
+    def save(self, path):
+        with self.lock:
+            entries = dict(self.entries)
+        try:
+            with open(path + ".tmp", "w", encoding="utf-8") as fp:
+                json.dump(entries, fp)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            signalLog.error("Cannot write name cache %s: %r", path, e)
+#end class NameCache
+
+nameCache = NameCache(name_ttl, name_cachesize)
+nameCacheFile = os.path.join(data_dir, "namecache.json")
+
+# messages seen at intake, so one that signal-cli delivers again or that is ingested
+# twice is dropped before rendering. Keys are short hashes of account, sender,
+# timestamp and group, kept in memory oldest first. A message is claimed when it
+# arrives and written to the append-only log once its mail is in the outbox, so
+# after a restart only messages that really were forwarded count as seen; the log
+# is rewritten with the live keys on load and whenever it grows too long.
+class DedupeIndex:
+    def __init__(self, path, maxsize, maxage):
+        self.path = path
+        self.maxsize = maxsize
+        self.maxage = maxage
+        self.entries = collections.OrderedDict() # key -> (time first seen, in the log)
+        self.lock = threading.Lock()
+        self.log = None
+        self.logged = 0 # lines in the log
+
+    def key(self, account, timestamp, sender, groupId):
+        text = account.signalnumber + "|" + str(sender) + "|" + str(timestamp) + "|" + bytes(groupId or []).hex()
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+    # True for a message seen before, otherwise it is claimed
+    def seen(self, account, timestamp, sender, groupId):
+        if self.maxsize <= 0:
+            return False
+        key = self.key(account, timestamp, sender, groupId)
+        now = time.time()
+        with self.lock:
+            if key in self.entries and self.entries[key][0] + self.maxage > now:
+                return True
+            self.entries[key] = (now, False)
+            self.entries.move_to_end(key)
+            self.evict(now)
+        return False
+
+    # messages of a mail that is in the outbox, in the form msgRcvV2 queues them
+    def commit(self, account, messages):
+        if self.maxsize <= 0:
+            return
+        lines = []
+        with self.lock:
+            for timestamp, sender, groupId, message, extras in messages:
+                key = self.key(account, timestamp, sender, groupId)
+                seenAt = self.entries.get(key, (time.time(), False))[0]
+                if key in self.entries:
+                    self.entries[key] = (seenAt, True)
+                lines.append("%d %s\n" % (seenAt, key))
+            try:
+                if self.log is None:
+                    self.log = open(self.path, "a", encoding="utf-8")
+                self.log.write("".join(lines))
+                self.log.flush()
+            except OSError as e:
+                intakeLog.error("Cannot write dedupe log %s: %r", self.path, e)
+                return
+            self.logged += len(lines)
+            if self.logged > 2 * self.maxsize:
+                self.compact()
+
+    # gives up the claims of messages that could not be forwarded, so signal-cli
+    # delivering them again is not taken for a duplicate
+    def release(self, account, messages):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            for timestamp, sender, groupId, message, extras in messages:
+                key = self.key(account, timestamp, sender, groupId)
+                if key in self.entries and not self.entries[key][1]:
+                    del self.entries[key]
+
+    # drops the oldest keys beyond maxsize or maxage, with the lock held
+    def evict(self, now):
+        while self.entries and (len(self.entries) > self.maxsize or next(iter(self.entries.values()))[0] + self.maxage <= now):
+            self.entries.popitem(last=False)
+
+    def load(self):
+        if self.maxsize <= 0:
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as fp:
+                with self.lock:
+                    for line in fp:
+                        try:
+                            seenAt, key = line.split()
+                            self.entries[key] = (float(seenAt), True)
+                        except ValueError:
+                            continue # torn last line after a crash
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            intakeLog.error("Cannot read dedupe log %s: %r", self.path, e)
+            return
+        with self.lock:
+            self.evict(time.time())
+            self.compact()
+        intakeLog.debug("remembering %d forwarded messages from %s", len(self.entries), self.path)
+
+    # rewrites the log with the keys in memory that were logged, with the lock held
+    def compact(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+        try:
+            with open(self.path + ".tmp", "w", encoding="utf-8") as fp:
+                self.logged = 0
+                for key, (seenAt, logged) in self.entries.items():
+                    if logged:
+                        fp.write("%d %s\n" % (seenAt, key))
+                        self.logged += 1
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            intakeLog.error("Cannot write dedupe log %s: %r", self.path, e)
+
+    def close(self):
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+#end class DedupeIndex
+
+dedupe = DedupeIndex(os.path.join(data_dir, "dedupe.log"), dedupe_entries, dedupe_max_age)
+
+# names are cached per account, each Signal account has its own contact list
+def contactKey(account, number):
+    return "contact:" + account.signalnumber + ":" + number
+
+def getContactName(account, number):
+    return nameCache.get(contactKey(account, number), lambda: account.signal_client.getContactName(number))
+
+def getGroupName(account, groupId):
+    groupIdEncoded = base64.b64encode(bytes(groupId)).decode("utf-8")
+    return nameCache.get("group:" + account.signalnumber + ":" + groupIdEncoded, lambda: account.signal_client.getGroupName(groupId))
+
+def setContactName(account, number, name):
+    nameCache.invalidate(contactKey(account, number))
+    account.signal_client.setContactName(number, name)
+    nameCache.put(contactKey(account, number), name)
+
+# rereads config_file and swaps in the new settings if they are valid, keeping the
+# running ones otherwise; settings outside Settings need a restart to change
+def reloadSettings():
+    global settings
+    config = configparser.ConfigParser()
+    config.optionxform = lambda option: option # otherwise it's lowercase only
+    try:
+        if not config.read(config_file):
+            raise OSError("cannot read " + config_file)
+        newSettings = Settings(config)
+    except KeyError as key:
+        log.error("Cannot reload %s, missing key %s, keeping the running configuration", config_file, key)
+        return False
+    except (OSError, ValueError, configparser.Error) as e:
+        log.error("Cannot reload %s, keeping the running configuration: %r", config_file, e)
+        return False
+    current = settings
+    if set(newSettings.accountsByNumber) != set(current.accountsByNumber):
+        log.error("Cannot reload %s, adding or removing a Signal account needs a restart", config_file)
+        return False
+    # the connections to signal-cli stay
+    for account in newSettings.accounts:
+        account.signal_client = current.accountsByNumber[account.signalnumber].signal_client
+    settings = newSettings
+    log.info("reloaded %s", config_file)
+    if newSettings.contacts != current.contacts:
+        syncContacts()
+    return True
+
+reloadRequested = threading.Event()
+
+def watchConfig():
+    try:
+        mtime = os.stat(config_file).st_mtime_ns
+    except OSError:
+        mtime = None
+    while True:
+        requested = reloadRequested.wait(config_reload if config_reload > 0 else None)
+        reloadRequested.clear()
+        try:
+            changed = os.stat(config_file).st_mtime_ns
+        except OSError:
+            continue
+        if requested or changed != mtime:
+            mtime = changed
+            reloadSettings()
+
+# reloads in a thread of its own, so parsing and compiling the file never holds up the main loop
+def startConfigWatch():
+    signal.signal(signal.SIGHUP, lambda signum, frame: reloadRequested.set())
+    threading.Thread(target=watchConfig, name="config", daemon=True).start()
+
+# timers of the main loop, GLib's or the callback loop of the JSON-RPC transport
+def addTimer(seconds, callback, *args):
+    if signal_transport == "jsonrpc":
+        return callbackLoop.timeout(seconds, callback, *args)
+    return GLib.timeout_add_seconds(seconds, callback, *args)
+
+def removeTimer(timer):
+    if signal_transport == "jsonrpc":
+        timer.cancel()
+    else:
+        GLib.source_remove(timer)
+
+# main loop of the JSON-RPC transport, standing in for GLib's: incoming messages
+# and timers are handled one after another on the thread calling run()
+class CallbackLoop:
+    def __init__(self):
+        self.callbacks = queue.SimpleQueue()
+        self.running = False
+
+    # thread safe
+    def post(self, callback, *args):
+        self.callbacks.put((callback, args))
+
+    def timeout(self, seconds, callback, *args):
+        timer = threading.Timer(seconds, self.post, (callback,) + args)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def run(self):
+        self.running = True
+        while self.running:
+            callback, args = self.callbacks.get()
+            try:
+                callback(*args)
+            except Exception as e:
+                intakeLog.error("Cannot handle %s: %r", getattr(callback, "__name__", callback), e)
+
+    def quit(self):
+        self.post(self.stop)
+
+    def stop(self):
+        self.running = False
+#end class CallbackLoop
+
+callbackLoop = CallbackLoop()
+
+unknownAccounts = set()
+
+# incoming message from the JSON-RPC daemon, in the callback loop; a daemon serving
+# several accounts sends the messages of accounts not configured here as well
+def receiveEnvelope(record):
+    number = record.get("account")
+    if number and number not in settings.accountsByNumber:
+        # warns once per account, they can be busy
+        if number not in unknownAccounts:
+            unknownAccounts.add(number)
+            intakeLog.warning("dropping messages for %s, not a configured account", number)
+        metrics.count("signalmail_messages_unknown_account_total")
+        return
+    job = parseEnvelope(record)
+    if job is None:
+        intakeLog.debug("no message in %s", record)
+        return
+    msgRcvV2(*job)
+
+# seconds to wait for a reply of signal-cli, and the longest line it may send
+jsonrpc_timeout = 120
+jsonrpc_linelimit = 16 * 1024 * 1024
+
+class JsonRpcError(Exception):
+    pass
+
+# connection to the JSON-RPC daemon of signal-cli, shared by all accounts. An asyncio
+# loop in its own thread reads replies and incoming messages; calls from other threads
+# are written right away and matched to their replies by id, so the lookups of several
+# workers are in flight at the same time. Lost connections are reopened.
+class JsonRpcConnection:
+    def __init__(self, address, onReceive=None):
+        self.address = address
+        self.loop = asyncio.new_event_loop()
+        self.writer = None
+        self.reader = None
+        self.replies = {} # request id -> future, only touched in the loop
+        self.ids = itertools.count(1)
+        self.onReceive = onReceive # called with the params of every "receive" notification
+
+    # connects in the calling thread, so a missing daemon is reported right away
+    def start(self):
+        self.loop.run_until_complete(self.connect())
+        threading.Thread(target=self.loop.run_forever, name="jsonrpc", daemon=True).start()
+
+    async def connect(self):
+        if self.address.startswith("/") or ":" not in self.address:
+            reader, self.writer = await asyncio.open_unix_connection(self.address, limit=jsonrpc_linelimit)
+        else:
+            host, port = self.address.rsplit(":", 1)
+            reader, self.writer = await asyncio.open_connection(host, int(port), limit=jsonrpc_linelimit)
+        self.reader = self.loop.create_task(self.read(reader))
+        signalLog.debug("connected to signal-cli at %s", self.address)
+
+    async def read(self, reader):
+        while True:
+            try:
+                line = await reader.readline()
+            except (OSError, ValueError) as e:
+                signalLog.error("Cannot read from signal-cli at %s: %r", self.address, e)
+                break
+            if not line:
+                break
+            try:
+                message = json.loads(line)
+            except ValueError as e:
+                signalLog.error("Cannot parse reply of signal-cli: %r", e)
+                continue
+            if "method" not in message:
+                future = self.replies.pop(message.get("id"), None)
+                if future is None or future.done():
+                    continue
+                if "error" in message:
+                    future.set_exception(JsonRpcError(str(message["error"].get("message", message["error"]))))
+                else:
+                    future.set_result(message.get("result"))
+            elif message["method"] == "receive" and self.onReceive is not None:
+                self.onReceive(message.get("params") or {})
+        signalLog.warning("Connection to signal-cli at %s lost, reconnecting", self.address)
+        self.writer.close()
+        self.writer = None
+        for future in self.replies.values():
+            if not future.done():
+                future.set_exception(ConnectionError("connection to signal-cli lost"))
+        self.replies.clear()
+        delay = 1
+        while self.writer is None:
+            await asyncio.sleep(delay)
+            try:
+                await self.connect()
+            except OSError as e:
+                signalLog.debug("cannot reconnect: %r", e)
+                delay = min(delay * 2, 60)
+
+    async def request(self, method, params):
+        if self.writer is None:
+            raise ConnectionError("not connected to signal-cli at " + self.address)
+        requestId = next(self.ids)
+        future = self.loop.create_future()
+        self.replies[requestId] = future
+        try:
+            self.writer.write(json.dumps({"jsonrpc": "2.0", "id": requestId, "method": method, "params": params}).encode("utf-8") + b"\n")
+            await self.writer.drain()
+            return await future
+        finally:
+            self.replies.pop(requestId, None)
+
+    # blocking call for every thread but the loop's own
+    def call(self, method, params):
+        return asyncio.run_coroutine_threadsafe(self.request(method, params), self.loop).result(jsonrpc_timeout)
+#end class JsonRpcConnection
+
+# what signalmail needs of the DBus object of signal-cli, over JSON-RPC
+class JsonRpcSignal:
+    def __init__(self, connection, signalnumber, multiAccount):
+        self.connection = connection
+        self.signalnumber = signalnumber
+        self.multiAccount = multiAccount
+
+    def call(self, method, **params):
+        # a daemon serving several accounts needs to know which one is meant
+        if self.multiAccount:
+            params["account"] = self.signalnumber
+        return self.connection.call(method, params)
+
+    def getContactName(self, number):
+        for contact in self.call("listContacts", recipient=[number]) or []:
+            if number in (contact.get("number"), contact.get("uuid")):
+                return contact.get("name") or ""
+        return ""
+
+    def getGroupName(self, groupId):
+        groupIdEncoded = base64.b64encode(bytes(groupId)).decode("utf-8")
+        for group in self.call("listGroups", groupId=[groupIdEncoded]) or []:
+            if group.get("id") == groupIdEncoded:
+                return group.get("name") or ""
+        return ""
+
+    def setContactName(self, number, name):
+        self.call("updateContact", recipient=number, name=name)
+
+    def sendMessage(self, message, attachments, recipient):
+        result = self.call("send", recipient=[recipient], message=message, attachments=attachments)
+        return (result or {}).get("timestamp")
+
+    def getSelfNumber(self):
+        return self.signalnumber
+#end class JsonRpcSignal
+
+# onReceive is set before connecting, signal-cli does not keep messages nobody listened to
+def connectToJsonRpc(accounts, onReceive=None):
+    connection = JsonRpcConnection(jsonrpc_address, onReceive)
+    try:
+        connection.start()
+    except OSError as e:
+        print("Daemon error -- cannot connect to signal-cli at " + jsonrpc_address + ", did you start it with daemon --socket or --tcp?", file=sys.stderr)
+        print(e, " ", type(e), file=sys.stderr)
+        raise SystemExit(1)
+    for account in accounts:
+        account.signal_client = JsonRpcSignal(connection, account.signalnumber, len(accounts) > 1)
+    return connection
+
+# connects all accounts over one bus, setting account.signal_client
+def connectToDBus(accounts):
     if sessiondbus:
         bus = SessionBus()
-        try:
-            signal_client = bus.get('org.asamk.Signal', '_' + signalnumber[1:])
-            if debug: print("Using session DBus for /org/asamk/Signal/_" + signalnumber[1:])
-        except:
-            if debug: print("Could not connect to DBus using /org/asamk/Signal/_" + signalnumber[1:] + ", trying alternative")
+        for account in accounts:
+            signalnumber = account.signalnumber
             try:
-                signal_client = bus.get('org.asamk.Signal')
-                if (signalnumber != signal_client.getSelfNumber()):
-                    raise SystemExit(1)
-                if debug: print("Using session DBus on /org/asamk/Signal")
+                account.signal_client = bus.get('org.asamk.Signal', '_' + signalnumber[1:])
+                signalLog.debug("Using session DBus for /org/asamk/Signal/_%s", signalnumber[1:])
             except:
-                if debug: print("Could not connect to DBus using /org/asamk/Signal")
-                print("Daemon error -- did you remember to specify --username to signal-cli and start it in daemon mode?", file=sys.stderr)
-                raise SystemExit(1)
+                signalLog.debug("Could not connect to DBus using /org/asamk/Signal/_%s, trying alternative", signalnumber[1:])
+                try:
+                    # single-account daemon, only serves one number
+                    account.signal_client = bus.get('org.asamk.Signal')
+                    if (signalnumber != account.signal_client.getSelfNumber()):
+                        raise SystemExit(1)
+                    signalLog.debug("Using session DBus on /org/asamk/Signal")
+                except:
+                    signalLog.debug("Could not connect to DBus using /org/asamk/Signal")
+                    print("Daemon error -- did you remember to specify --username to signal-cli and start it in daemon mode?", file=sys.stderr)
+                    raise SystemExit(1)
     else:
         try:
             bus = SystemBus()
-            signal_client = bus.get('org.asamk.Signal', '_' + signalnumber[1:])
-            if debug: print("Using system DBus for /org/asamk/Signal/_" + signalnumber[1:])
+            for account in accounts:
+                signalnumber = account.signalnumber
+                account.signal_client = bus.get('org.asamk.Signal', '_' + signalnumber[1:])
+                signalLog.debug("Using system DBus for /org/asamk/Signal/_%s", signalnumber[1:])
         except:
-            if debug: print("Could not connect to system DBus")
+            signalLog.debug("Could not connect to system DBus")
             print("Daemon error -- did you remember to specify --system to signal-cli and start it in daemon mode?", file=sys.stderr)
             raise SystemExit(1)
-    return signal_client
-#end connectToDBus():
+    return bus
+#end connectToDBus(accounts):
 
 @singledispatch
 def get_attachmentFile(rawAttachment):
-    print("Attachment type unknown", type(rawAttachment), file=sys.stderr)
+    attachmentLog.error("Attachment type unknown %s", type(rawAttachment))
     raise SystemExit(1)
     return
 @get_attachmentFile.register
@@ -518,37 +2930,52 @@ def _(arg: str, verbose=False):
 
 @singledispatch
 def get_attachmentContentType(rawAttachment):
-    return attachmentContentType, raw_data
+    return attachmentContentType
 @get_attachmentContentType.register
 def _(arg: dict, verbose=False):
     attachmentContentType = arg["contentType"]
-    if debug: print("Content-type: " + attachmentContentType)
-    fp = open(get_attachmentFile(arg), 'rb') #open in binary format
-    raw_data = fp.read()
-    fp.close()
-    return attachmentContentType, raw_data
+    attachmentLog.debug("Content-type: %s", attachmentContentType)
+    return attachmentContentType
 @get_attachmentContentType.register
 def _(arg: tuple, verbose=False):
     attachmentContentType = arg[0]
-    if debug: print("Content-type: " + attachmentContentType)
-    fp = open(get_attachmentFile(arg), 'rb') #open in binary format
-    raw_data = fp.read()
-    fp.close()
-    return attachmentContentType, raw_data
+    attachmentLog.debug("Content-type: %s", attachmentContentType)
+    return attachmentContentType
 @get_attachmentContentType.register
 def _(arg: str, verbose=False):
-    fp = open(get_attachmentFile(arg), 'rb') #open in binary format
-    raw_data = fp.read()
-    fp.close()
     # .. try to find out MIME type and process it properly
-    if debug: print("Guess MIME type of file '" + get_attachmentFile(arg) + "'")
-    mime = magic.Magic(mime=True)
-    ctype = mime.from_buffer(raw_data)
-    if debug: print("ctype: ", ctype)
+    attachment = get_attachmentFile(arg)
+    attachmentLog.debug("Guess MIME type of file '%s'", attachment)
+    stat = os.stat(attachment)
+    ctype = sniffContentType(attachment, stat.st_size, stat.st_mtime_ns)
+    attachmentLog.debug("ctype: %s", ctype)
+    return ctype
+#end get_attachmentContentType(rawAttachment):
+
+# bytes read from the start of a file to guess its MIME type
+mime_sniffsize = 8192
+
+# created on first use and shared, libmagic handles must not be used by two threads at once
+mimeDetector = None
+mimeDetectorLock = threading.Lock()
+
+# size and modification time are part of the key, so a replaced file is sniffed again
+@lru_cache(maxsize=1024)
+def sniffContentType(path, size, mtime):
+    global mimeDetector
+    with open(path, 'rb') as fp:
+        header = fp.read(mime_sniffsize)
+    with mimeDetectorLock:
+        if mimeDetector is None:
+            mimeDetector = magic.Magic(mime=True)
+        ctype = mimeDetector.from_buffer(header)
     if ctype is None:
         ctype = "application/octet-stream"
-    return ctype, raw_data
-#end get_attachmentContentType(rawAttachment):
+    return ctype
+
+@lru_cache(maxsize=256)
+def guessExtension(ctype):
+    return mimetypes.guess_extension(ctype, strict=False) or ""
 
 @singledispatch
 def get_attachmentFileSize(rawAttachment):